@@ -0,0 +1,80 @@
+"""
+Wrappers around the core vocabulary and tag actions.
+
+These are registered through ``IActions`` so that any change to a
+vocabulary or its tags, whether made through the API, the web interface
+or the ``paster example`` commands, drops the extension's cached copies
+and updates the tag index.
+"""
+from ckan.logic.action import create, update, delete
+
+import cache
+from tagindex import tag_index
+
+
+def _wraps(action):
+    def decorator(wrapper):
+        wrapper.__name__ = action.__name__
+        wrapper.__doc__ = action.__doc__
+        return wrapper
+    return decorator
+
+
+@_wraps(create.tag_create)
+def tag_create(context, data_dict):
+    tag = create.tag_create(context, data_dict)
+    cache.invalidate_vocabularies()
+    tag_index.add_tag(tag.get('vocabulary_id'), tag['name'], tag['id'])
+    return tag
+
+
+@_wraps(delete.tag_delete)
+def tag_delete(context, data_dict):
+    # Both the tag and its vocabulary may be given by name or id, and the
+    # vocabulary may be left out, so find which tag is deleted first.
+    model = context['model']
+    tag = model.Tag.get(data_dict.get('id'), data_dict.get('vocabulary_id'))
+    deleted = tag and (tag.vocabulary_id, tag.name)
+    result = delete.tag_delete(context, data_dict)
+    cache.invalidate_vocabularies()
+    if deleted:
+        tag_index.remove_tag(*deleted)
+    else:
+        tag_index.drop()
+    return result
+
+
+@_wraps(create.vocabulary_create)
+def vocabulary_create(context, data_dict):
+    vocab = create.vocabulary_create(context, data_dict)
+    cache.invalidate_vocabularies()
+    tag_index.drop(vocab['name'])
+    return vocab
+
+
+@_wraps(update.vocabulary_update)
+def vocabulary_update(context, data_dict):
+    vocab = update.vocabulary_update(context, data_dict)
+    cache.invalidate_vocabularies()
+    # The vocabulary may have been renamed, so we can't tell which entry
+    # to drop.
+    tag_index.drop()
+    return vocab
+
+
+@_wraps(delete.vocabulary_delete)
+def vocabulary_delete(context, data_dict):
+    result = delete.vocabulary_delete(context, data_dict)
+    cache.invalidate_vocabularies()
+    tag_index.drop()
+    return result
+
+
+def get_actions():
+    return {
+        'tag_create': tag_create,
+        'tag_delete': tag_delete,
+        'vocabulary_create': vocabulary_create,
+        'vocabulary_update': vocabulary_update,
+        'vocabulary_delete': vocabulary_delete,
+    }
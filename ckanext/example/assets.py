@@ -0,0 +1,221 @@
+"""
+Fingerprinted static assets of the example theme.
+
+``paster example build-assets`` bundles and minifies the theme's
+stylesheets, and writes each asset to ``theme/public/dist`` under a name
+containing a hash of its content, along with gzip (and, if the
+``brotli`` module is installed, brotli) compressed copies.  A manifest
+maps each asset to its fingerprinted name.
+
+The plugins link to the assets through ``urls()``, which returns the
+fingerprinted URLs under ``/dist/``, or the original unversioned files if
+the assets have not been built.  As ``theme/public`` is one of CKAN's
+``extra_public_paths``, they are served by Paste's static file handler
+(or by the web server in front of CKAN, which can send the compressed
+copies), without going through a Pylons controller.
+``ExampleController.asset`` still serves them, with the compressed copy
+the browser accepts, under ``/example/assets/``, where earlier builds
+linked to.
+"""
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+PUBLIC_DIR = os.path.join(os.path.dirname(__file__), 'theme', 'public')
+DIST_DIR = os.path.join(PUBLIC_DIR, 'dist')
+MANIFEST = 'manifest.json'
+
+# The URL the fingerprinted assets are linked to, served from ``DIST_DIR``
+# as static files
+DIST_URL = '/dist/'
+
+# The URL ``ExampleController.asset`` serves them from
+URL_PREFIX = '/example/assets/'
+
+# The compressed copies, by content coding, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Bundled stylesheets, and the files they are made of, relative to
+# ``PUBLIC_DIR``.
+BUNDLES = {
+    'css/example.css': ['css/extra.css', 'css/chosen.css'],
+}
+
+# Files copied as they are
+FILES = ['scripts/chosen.jquery.min.js', 'scripts/vocab-autocomplete.js']
+
+# Only compress files which are worth it
+COMPRESSED_EXTENSIONS = ('.css', '.js')
+
+_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+# original name -> fingerprinted file name, once the assets are built
+_manifest = {}
+
+
+def minify_css(css):
+    """
+    Strips the comments and the whitespace which isn't needed from a
+    stylesheet.
+    """
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    # A colon followed by a space can't be a pseudo-class
+    css = re.sub(r':\s+', ':', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def fingerprinted(name, content):
+    """
+    Returns the file name of the ``name`` asset with the hash of its
+    ``content``, e.g. ``example.0123456789ab.css``.
+    """
+    stem, ext = os.path.splitext(os.path.basename(name))
+    return '%s.%s%s' % (stem, hashlib.sha1(content).hexdigest()[:12], ext)
+
+
+class AssetBuilder(object):
+    """Writes the fingerprinted assets and their manifest to ``dist_dir``.
+    """
+
+    def __init__(self, public_dir=PUBLIC_DIR, dist_dir=DIST_DIR):
+        self.public_dir = public_dir
+        self.dist_dir = dist_dir
+        self.manifest = {}
+
+    def _read(self, name):
+        with open(os.path.join(self.public_dir, name), 'rb') as f:
+            return f.read()
+
+    def _write(self, name, content):
+        filename = fingerprinted(name, content)
+        path = os.path.join(self.dist_dir, filename)
+        with open(path, 'wb') as f:
+            f.write(content)
+        if name.endswith(COMPRESSED_EXTENSIONS):
+            with open(path + '.gz', 'wb') as f:
+                gz = gzip.GzipFile(filename, 'wb', 9, f, mtime=0)
+                gz.write(content)
+                gz.close()
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(content))
+        self.manifest[name] = filename
+        log.info('%s -> %s (%d bytes)' % (name, filename, len(content)))
+        return filename
+
+    def _rewrite_urls(self, source, css):
+        """
+        Points the relative ``url()`` references of a stylesheet at the
+        fingerprinted copies of the files they refer to.
+        """
+        def replace(match):
+            url = match.group(2)
+            if url.startswith(('/', 'data:', 'http:', 'https:')):
+                return match.group(0)
+            name = os.path.normpath(
+                os.path.join(os.path.dirname(source), url))
+            if name not in self.manifest:
+                self._write(name, self._read(name))
+            # Relative to the bundle, which is in the same directory
+            return 'url(%s)' % self.manifest[name]
+        return _URL_RE.sub(replace, css)
+
+    def build(self):
+        """
+        Builds every asset, and returns the manifest.
+        """
+        if os.path.isdir(self.dist_dir):
+            shutil.rmtree(self.dist_dir)
+        os.makedirs(self.dist_dir)
+        for name, sources in sorted(BUNDLES.items()):
+            css = '\n'.join(self._rewrite_urls(source, self._read(source))
+                            for source in sources)
+            self._write(name, minify_css(css))
+        for name in FILES:
+            self._write(name, self._read(name))
+        with open(os.path.join(self.dist_dir, MANIFEST), 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        return self.manifest
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    """
+    Loads the manifest of the built assets, if there is one.
+    """
+    global _manifest
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as f:
+            _manifest = json.load(f)
+    except IOError:
+        log.info('No built assets found in %s, serving the original files'
+                 % dist_dir)
+        _manifest = {}
+    return _manifest
+
+
+def manifest_hash():
+    """
+    Returns a hash of the manifest, which changes whenever an asset does.
+    """
+    return hashlib.sha1(json.dumps(_manifest, sort_keys=True)).hexdigest()
+
+
+def urls(name):
+    """
+    Returns the URLs to link to for the ``name`` asset: its fingerprinted
+    copy if the assets are built, or else the original file(s).
+    """
+    if name in _manifest:
+        return [DIST_URL + _manifest[name]]
+    return ['/' + source for source in BUNDLES.get(name, [name])]
+
+
+def accepted_encoding(header):
+    """
+    Returns the first of ``ENCODINGS`` an ``Accept-Encoding`` header
+    accepts, as a ``(coding, extension)`` pair, or None.  Codings given a
+    quality of 0, e.g. ``gzip;q=0``, are refused, including by ``*;q=0``.
+    """
+    qualities = {}
+    for item in (header or '').split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    for coding, extension in ENCODINGS:
+        if qualities.get(coding, qualities.get('*', 0)) > 0:
+            return coding, extension
+    return None
+
+
+def path(filename):
+    """
+    Returns the path of a built asset file, or None if there is no such
+    file in the manifest.
+    """
+    if filename not in _manifest.values():
+        return None
+    return os.path.join(DIST_DIR, filename)
@@ -0,0 +1,51 @@
+"""
+Prefix search of vocabulary tags, served by
+``ExampleController.tag_autocomplete``.
+
+The dataset form only renders the vocabulary tags a dataset already has,
+and fetches the others as the user types.  Each vocabulary's tag names are
+kept sorted by their lower case form, so that the tags starting with a
+prefix are found by bisection, whatever the size of the vocabulary.
+"""
+import bisect
+
+import cache
+
+# The largest number of tags returned at once
+MAX_LIMIT = 100
+
+# vocabulary name -> (sorted lower case tag names, tag names in the same
+# order), or None for a vocabulary that does not exist
+_sorted_tags = cache.Cache('tag_prefix', maxsize=64, ttl=300)
+cache.register(_sorted_tags, vocabulary=True)
+
+
+def _load(vocab_name):
+    tags = cache.get_vocabulary_tags(vocab_name)
+    if tags is None:
+        return None
+    pairs = sorted((tag.lower(), tag) for tag in tags)
+    return tuple(key for key, tag in pairs), tuple(tag for key, tag in pairs)
+
+
+def search(vocab_name, prefix, offset=0, limit=20):
+    """
+    Returns the list of the tags of the named vocabulary which start with
+    ``prefix``, ignoring case, in alphabetical order from the ``offset``th
+    one, at most ``limit`` of them, and whether there are more.  Returns
+    None if the vocabulary does not exist.
+    """
+    cache.sync()
+    entry = _sorted_tags.get_or_create(vocab_name,
+                                       lambda: _load(vocab_name))
+    if entry is None:
+        return None
+    keys, tags = entry
+    prefix = prefix.lower()
+    start = bisect.bisect_left(keys, prefix) + offset
+    found = []
+    for i in xrange(start, min(start + limit + 1, len(keys))):
+        if not keys[i].startswith(prefix):
+            break
+        found.append(tags[i])
+    return found[:limit], len(found) > limit
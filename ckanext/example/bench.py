@@ -0,0 +1,540 @@
+"""
+Benchmarks of the extension's hot paths.
+
+Run them with ``paster example bench``.  ``run_suite()`` seeds a local
+SQLite stand-in database (see ``standin.py``) with synthetic data, times
+the plugins' hooks against it and returns the results, which the command
+writes as JSON so that runs can be compared over time.  Each benchmark
+returns a dict of its results.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import itertools
+import subprocess
+
+from genshi.core import Stream
+from genshi.input import HTML
+from genshi.filters.transform import Transformer
+
+import transforms
+
+SIDEBAR_PATH = "//div[@id='sidebar']//ul[@class='widget-list']"
+
+
+def synthetic_dataset_page(items=1000):
+    """
+    Returns the markup of a dataset page with ``items`` resources and
+    sidebar entries, containing every element our rules select.
+    """
+    html = [u'<html><head><title>Dataset</title></head><body>',
+            u'<div id="content">'
+            u'<p id="examplething">Here is the frob, and another frob</p>',
+            u'<ul class="resources">']
+    for i in range(items):
+        html.append(u'<li class="resource"><a href="/dataset/d/resource/%d">'
+                    u'Resource %d</a> <span class="format">CSV</span></li>'
+                    % (i, i))
+    html.append(u'</ul></div><div id="sidebar"><ul class="widget-list">')
+    for i in range(items):
+        html.append(u'<li class="widget"><h3>Widget %d</h3>'
+                    u'<p>Some text about widget %d</p></li>' % (i, i))
+    html.append(u'</ul></div></body></html>')
+    return u''.join(html)
+
+
+def _status(field):
+    """
+    Returns a memory field of ``/proc/self/status``, e.g. ``VmRSS``, in
+    bytes.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+
+def _peak_memory(func):
+    """
+    Returns how much the resident memory of a forked copy of this process
+    grew at most while calling ``func`` once, in bytes, or None where the
+    kernel can't reset the peak (``VmHWM``), i.e. other than on Linux.
+    Memory the process had already allocated and freed is reused first,
+    so this is the growth the call causes rather than all it allocates.
+    """
+    if not os.path.exists('/proc/self/clear_refs'):
+        return None
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        peak = ''
+        try:
+            os.close(read_end)
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            before = _status('VmHWM')
+            func()
+            peak = str(_status('VmHWM') - before)
+        finally:
+            os.write(write_end, peak)
+            os._exit(0)
+    os.close(write_end)
+    try:
+        peak = os.read(read_end, 64)
+    finally:
+        os.close(read_end)
+        os.waitpid(pid, 0)
+    return int(peak) if peak else None
+
+
+def _measure(func, repeat, memory=False):
+    """
+    Returns the mean time per call of ``func`` in seconds, and if
+    ``memory`` is True the peak memory it allocated in bytes (see
+    ``_peak_memory``), else None.  ``func`` is then also called in a
+    forked process, so it must not use a database connection.
+    """
+    gc.collect()
+    # Before the timed calls, which leave freed memory for the next ones
+    peak = _peak_memory(func) if memory else None
+    start = time.time()
+    for i in range(repeat):
+        func()
+    elapsed = (time.time() - start) / repeat
+    return elapsed, peak
+
+
+def bench_stream_rules(items=1000, repeat=20):
+    """
+    Compares applying every stream rule of the package edit and read pages
+    with one chained ``Transformer`` per rule, as the plugins used to, and
+    with a single ``transforms.apply_rules`` pass.
+    """
+    page = list(HTML(synthetic_dataset_page(items)))
+    css = HTML(u'<link rel="stylesheet" href="/css/chosen.css" />')
+    script = HTML(u'<script src="/scripts/chosen.jquery.min.js"></script>')
+    genre = HTML(u'<li class="sidebar-section"><h3>Musical Genre</h3>'
+                 u'<ul class="tags clearfix"><li>jazz</li></ul></li>')
+    composer = HTML(u'<li class="sidebar-section"><h3>Composer</h3>'
+                    u'<ul class="tags clearfix"><li>Bob Mintzer</li></ul></li>')
+
+    chained = [
+        Transformer('//p[@id="examplething"]/text()')
+            .substitute(r'frob', r'foobar'),
+        Transformer('head').append(css),
+        Transformer('body').append(script),
+        Transformer(SIDEBAR_PATH).append(genre),
+        Transformer(SIDEBAR_PATH).append(composer),
+    ]
+    rules = [
+        transforms.Rule('//p[@id="examplething"]/text()',
+                        transforms.SUBSTITUTE,
+                        pattern=r'frob', replace=r'foobar'),
+        transforms.Rule('head', transforms.APPEND, content=css),
+        transforms.Rule('body', transforms.APPEND, content=script),
+        transforms.Rule(SIDEBAR_PATH, transforms.APPEND,
+                        content=list(genre) + list(composer)),
+    ]
+
+    def run_chained():
+        stream = Stream(page)
+        for transformer in chained:
+            stream = stream | transformer
+        return stream.render('html')
+
+    def run_single_pass():
+        stream = transforms.RuleStream(Stream(page),
+                                       [rule.resolve() for rule in rules])
+        return stream.render('html')
+
+    assert run_chained() == run_single_pass(), \
+        'Chained and single pass transformations differ'
+
+    chained_time, chained_peak = _measure(run_chained, repeat, memory=True)
+    single_time, single_peak = _measure(run_single_pass, repeat,
+                                        memory=True)
+    return {
+        'benchmark': 'stream_rules',
+        'events': len(page),
+        'chained_ms_per_page': chained_time * 1000,
+        'single_pass_ms_per_page': single_time * 1000,
+        'chained_peak_bytes': chained_peak,
+        'single_pass_peak_bytes': single_peak,
+    }
+
+
+def describe_schema(schema):
+    """
+    Returns a comparable description of a schema, in which validators are
+    identified by their name and the values they close over, so that
+    schemas built by separate calls compare equal.  Lists and tuples are
+    told apart, as navl only treats lists as validators.
+    """
+    if isinstance(schema, dict):
+        return dict((key, describe_schema(value))
+                    for key, value in schema.iteritems())
+    if isinstance(schema, list):
+        return ('list', [describe_schema(value) for value in schema])
+    if isinstance(schema, tuple):
+        return ('tuple', [describe_schema(value) for value in schema])
+    if callable(schema):
+        closure = getattr(schema, 'func_closure', None) or ()
+        return (getattr(schema, '__module__', None),
+                getattr(schema, '__name__', repr(schema)),
+                tuple(cell.cell_contents for cell in closure))
+    return schema
+
+
+def bench_schemas(names, repeat=1000):
+    """
+    Compares building the form plugins' schemas on every call with the
+    cached schemas, after checking that both are identical and validate
+    sample data the same way.
+    """
+    import copy
+    from ckan.lib.navl.dictization_functions import validate
+    from forms import ExampleDatasetForm, ExampleGroupForm
+
+    pkg_dict = _package_dicts(names, limit=1)[0]
+    samples = {
+        (ExampleDatasetForm, 'form_to_db_schema'): {
+            'name': u'bench-schema-dataset', 'title': u'A dataset',
+            'tag_string': u'free, tags', 'published_by': u'A publisher',
+            'genre_tags': [tag['name'] for tag in pkg_dict['tags']
+                           if tag.get('vocabulary_id')][:1]},
+        (ExampleDatasetForm, 'db_to_form_schema'): pkg_dict,
+        (ExampleGroupForm, 'form_to_db_schema'): {
+            'name': u'bench-schema-group', 'title': u'A group'},
+        (ExampleGroupForm, 'db_to_form_schema'): {'name': u'a-group'},
+    }
+
+    result = {'benchmark': 'schemas'}
+    for plugin in (ExampleDatasetForm(), ExampleGroupForm()):
+        for name in ('form_to_db_schema', 'db_to_form_schema'):
+            method = getattr(plugin, name)
+            build = getattr(type(plugin), name).uncached
+            label = '%s.%s' % (type(plugin).__name__, name)
+            assert describe_schema(method()) == \
+                describe_schema(build(plugin)), \
+                '%s differs from the cached schema' % label
+            sample = samples[(type(plugin), name)]
+            assert validate(copy.deepcopy(sample), method(), _context()) == \
+                validate(copy.deepcopy(sample), build(plugin), _context()), \
+                '%s validates differently when cached' % label
+
+            fresh_time = _measure(lambda: build(plugin), repeat)[0]
+            cached_time = _measure(method, repeat)[0]
+            key = '%s.%s' % (type(plugin).__name__, name)
+            result[key + '.fresh_us'] = fresh_time * 1000000
+            result[key + '.cached_us'] = cached_time * 1000000
+    return result
+
+
+def _time(func, repeat):
+    """
+    Calls ``func`` ``repeat`` times, returning statistics of the time it
+    took in milliseconds.  The first call is reported separately, as it
+    is the one filling any caches.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000)
+    first = times[0]
+    times.sort()
+    return {
+        'first_ms': first,
+        'mean_ms': sum(times) / len(times),
+        'min_ms': times[0],
+        'p50_ms': times[len(times) // 2],
+        'p95_ms': times[int(len(times) * 0.95)],
+        'max_ms': times[-1],
+    }
+
+
+class RequestContext(object):
+    """Stand-in Pylons request and template context objects, registered
+    so that the plugins' hooks can be called outside of a request.
+    """
+
+    def __init__(self, registry):
+        import pylons
+        from pylons.util import AttribSafeContextObj
+        from webob import Request
+        self.c = AttribSafeContextObj()
+        self.c.user = ''
+        self.request = Request.blank('/')
+        self._environ = dict(self.request.environ)
+        registry.register(pylons.tmpl_context, self.c)
+        registry.register(pylons.request, self.request)
+
+    def new_request(self, controller, action):
+        """
+        Starts a new stand-in request to the given route.
+        """
+        self.request.environ.clear()
+        self.request.environ.update(self._environ)
+        self.request.environ['pylons.routes_dict'] = {
+            'controller': controller, 'action': action}
+
+
+def _context():
+    from ckan import model
+    return {'model': model, 'session': model.Session, 'user': ''}
+
+
+def _package_dicts(names, limit=50):
+    from ckan import model
+    from ckan.lib.dictization.model_dictize import package_dictize
+    return [package_dictize(model.Package.get(name), _context())
+            for name in names[:limit]]
+
+
+def bench_filters(request_context, names, page_size=1000, repeat=20):
+    """
+    Times the stream filters of both plugins on the pages they transform,
+    rendering the synthetic page of each dataset.
+    """
+    from plugin import ExamplePlugin
+    from forms import ExampleDatasetForm
+
+    page = list(HTML(synthetic_dataset_page(page_size)))
+    plugins = [ExamplePlugin(), ExampleDatasetForm()]
+    pkg_dicts = itertools.cycle(_package_dicts(names))
+    c = request_context.c
+
+    def render(controller, action):
+        def _render():
+            request_context.new_request(controller, action)
+            c.pkg_dict = pkg_dicts.next()
+            stream = Stream(page)
+            for plugin in plugins:
+                stream = plugin.filter(stream)
+            return stream.render('html')
+        return _render
+
+    result = {'benchmark': 'filters', 'page_events': len(page)}
+    for controller, action in [('package', 'read'), ('package', 'edit'),
+                               ('home', 'index'), ('user', 'read')]:
+        result['%s_%s' % (controller, action)] = \
+            _time(render(controller, action), repeat)
+    return result
+
+
+def bench_form_schemas(names, repeat=20):
+    """
+    Times validating a submitted dataset form with ``form_to_db_schema``
+    and a dataset read from the database with ``db_to_form_schema``.
+    """
+    from ckan.lib.navl.dictization_functions import validate
+    from forms import ExampleDatasetForm, GENRE_VOCAB, COMPOSER_VOCAB
+    from tagindex import tag_index
+
+    plugin = ExampleDatasetForm()
+    pkg_dicts = itertools.cycle(_package_dicts(names))
+    genre_tags = sorted(tag_index.vocabulary(GENRE_VOCAB)[1])[:10]
+    composer_tags = sorted(tag_index.vocabulary(COMPOSER_VOCAB)[1])[:10]
+    counter = itertools.count()
+
+    def form_to_db():
+        data = {
+            'name': u'bench-new-dataset-%d' % counter.next(),
+            'title': u'A new dataset',
+            'notes': u'Submitted by the benchmark.',
+            'tag_string': u'free, tags',
+            'published_by': u'Example publisher',
+            'genre_tags': genre_tags,
+            'composer_tags': composer_tags,
+        }
+        return validate(data, plugin.form_to_db_schema(), _context())
+
+    def db_to_form():
+        return validate(pkg_dicts.next(), plugin.db_to_form_schema(),
+                        _context())
+
+    return {'benchmark': 'form_schemas',
+            'form_to_db': _time(form_to_db, repeat),
+            'db_to_form': _time(db_to_form, repeat)}
+
+
+def bench_setup_template_variables(request_context, names, repeat=20):
+    """
+    Times setting up the dataset form's template variables, each call
+    being a new request to edit a dataset.
+    """
+    from ckan import model
+    from forms import ExampleDatasetForm
+
+    plugin = ExampleDatasetForm()
+    packages = itertools.cycle(names[:50])
+
+    def setup():
+        request_context.new_request('package', 'edit')
+        request_context.c.pkg = model.Package.get(packages.next())
+        plugin.setup_template_variables(_context(), {})
+
+    return {'benchmark': 'setup_template_variables',
+            'setup': _time(setup, repeat)}
+
+
+def bench_fieldset(names, repeat=20):
+    """
+    Compares building the FormAlchemy fieldset of the ``example_form`` for
+    every request with getting the cached one, checking that both render
+    a dataset's edit form the same way.
+    """
+    from ckan import model
+    from package_form import get_example_fieldset, build_example_fieldset
+    pkg = model.Package.get(names[0])
+    groups = model.Session.query(model.Group).all()
+
+    def render(fieldset):
+        return fieldset.bind(pkg).render()
+
+    assert render(get_example_fieldset(user_editable_groups=groups)) == \
+        render(build_example_fieldset(user_editable_groups=groups)), \
+        'Cached and fresh fieldsets differ'
+
+    return {'benchmark': 'fieldset',
+            'build_example_fieldset': _time(
+                lambda: build_example_fieldset(user_editable_groups=groups),
+                repeat),
+            'get_example_fieldset': _time(
+                lambda: get_example_fieldset(user_editable_groups=groups),
+                repeat),
+            'cached_bind_and_render': _time(
+                lambda: render(get_example_fieldset(
+                    user_editable_groups=groups)),
+                repeat)}
+
+
+def bench_template_lookup(repeat=20):
+    """
+    Compares resolving each of the theme's templates, and a core template,
+    through the search path the three plugins used to build (the theme's
+    directory three times, and an empty entry) with resolving them through
+    the template index, checking that both find the same files.
+    """
+    import os
+    from genshi.template.loader import directory
+    from templates import TEMPLATE_DIR, TemplateIndex
+
+    names = [os.path.relpath(os.path.join(dirpath, filename), TEMPLATE_DIR)
+             for dirpath, dirnames, filenames in os.walk(TEMPLATE_DIR)
+             for filename in filenames] + ['package/read_core.html']
+    index = TemplateIndex([TEMPLATE_DIR])
+    duplicated = [directory(path)
+                  for path in [TEMPLATE_DIR] * 3 + ['']]
+
+    def resolve(search_path):
+        found = []
+        for name in names:
+            for loadfunc in search_path:
+                try:
+                    filepath, filename, fileobj, uptodate = loadfunc(name)
+                except IOError:
+                    continue
+                fileobj.close()
+                found.append(filepath)
+                break
+        return found
+
+    assert resolve(duplicated) == resolve([index]), \
+        'The template index finds different files'
+
+    return {'benchmark': 'template_lookup',
+            'templates': len(names),
+            'duplicated_search_path': _time(
+                lambda: resolve(duplicated), repeat),
+            'template_index': _time(lambda: resolve([index]), repeat)}
+
+
+# Run in a fresh interpreter by ``bench_startup``: imports what every CKAN
+# worker loads anyway, then loads the three plugins' entry points, and
+# prints the time it took and the memory and modules it added as JSON.
+STARTUP_SCRIPT = """
+import os, sys, time, json, resource
+import pkg_resources
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+import ckan.config.middleware
+modules, memory, start = len(sys.modules), rss(), time.time()
+for name in %r:
+    for entry_point in pkg_resources.iter_entry_points('ckan.plugins', name):
+        entry_point.load()
+print json.dumps({'import_ms': (time.time() - start) * 1000,
+                  'rss_bytes': rss() - memory,
+                  'modules': len(sys.modules) - modules})
+"""
+
+STARTUP_PLUGINS = ('example', 'example_datasetform', 'example_groupform')
+
+
+def bench_startup(repeat=5):
+    """
+    Measures what loading the three plugins costs each worker: the time
+    taken to import them, and the resident memory and number of modules
+    they add to a process which has imported CKAN's application, each in
+    a new interpreter.  Reports the median of ``repeat`` runs.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    runs = []
+    for i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT % (STARTUP_PLUGINS,)],
+            env=env)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    def median(key):
+        return sorted(run[key] for run in runs)[len(runs) / 2]
+
+    return {'benchmark': 'startup',
+            'plugins': list(STARTUP_PLUGINS),
+            'import_ms': median('import_ms'),
+            'rss_bytes': median('rss_bytes'),
+            'modules': median('modules')}
+
+
+def run_suite(registry, datasets=100, tags=1000, page_size=1000, repeat=20,
+              database=None):
+    """
+    Runs every benchmark against a stand-in database seeded with
+    ``datasets`` datasets and ``tags`` tags per vocabulary, on synthetic
+    pages of ``page_size`` items, and returns the results.
+    """
+    import standin
+
+    database = standin.create(database)
+    try:
+        names = standin.seed(datasets=datasets, tags=tags)
+        request_context = RequestContext(registry)
+
+        results = [
+            bench_stream_rules(items=page_size, repeat=repeat),
+            bench_schemas(names, repeat=repeat * 50),
+            bench_filters(request_context, names, page_size, repeat),
+            bench_form_schemas(names, repeat),
+            bench_setup_template_variables(request_context, names, repeat),
+            bench_fieldset(names, repeat),
+            bench_template_lookup(repeat),
+            bench_startup(),
+        ]
+    finally:
+        standin.restore()
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'database': database,
+        'parameters': {'datasets': datasets, 'tags': tags,
+                       'page_size': page_size, 'repeat': repeat},
+        'results': results,
+    }
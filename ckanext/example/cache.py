@@ -0,0 +1,353 @@
+"""
+Process-level caches used by the example plugins.
+
+The vocabulary lookups done while rendering dataset pages hit the
+database on every request, although vocabularies change very rarely.
+The ``Cache`` class below keeps such results in memory for a bounded
+time and number of entries, and counts hits and misses so that its
+effectiveness can be checked (see ``ExampleController.cache_stats``).
+
+The vocabulary caches are loaded from the snapshot shared by the CKAN
+processes of the host (see ``snapshot.py``) when it is up to date, and
+dropped as soon as any process bumps the snapshot's generation.
+"""
+import time
+import threading
+import logging
+
+from sqlalchemy.util import OrderedDict
+from paste.deploy.converters import asint
+
+from pylons import request
+
+from ckan import model
+from ckan.logic import get_action, NotFound
+
+import snapshot
+from snapshot import SnapshotUnavailable
+
+log = logging.getLogger(__name__)
+
+# Marks a key which is not in the cache, so that ``None`` can be cached.
+_MISSING = object()
+
+
+class Cache(object):
+    """A thread-safe LRU cache whose entries expire after ``ttl`` seconds.
+
+    ``maxsize`` bounds the number of entries; the least recently used
+    entry is dropped when it is exceeded.  A ``ttl`` of ``None`` means
+    entries never expire and can only be removed by ``invalidate()`` or
+    ``clear()``.
+    """
+
+    def __init__(self, name, maxsize=128, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize=None, ttl=None):
+        """
+        Change the size and expiry bounds, dropping the current entries.
+        """
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            self.ttl = ttl
+            self._data.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    # re-insert to mark it as the most recently used
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                del self._data[iter(self._data).next()]
+
+    def get_or_create(self, key, creator):
+        """
+        Return the cached value for ``key``, calling ``creator()`` to
+        compute and store it on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = creator()
+            self.set(key, value)
+        return value
+
+    def items(self):
+        """
+        Returns a list of the ``(key, value)`` pairs which have not expired,
+        without counting them as hits.
+        """
+        now = time.time()
+        with self._lock:
+            return [(key, value)
+                    for key, (value, expires) in self._data.items()
+                    if expires is None or expires > now]
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Returns a dict of the hit and miss counters and current size.
+        """
+        return {'name': self.name,
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl}
+
+
+# Vocabularies by name, holding only their id and name (or ``None`` for a
+# vocabulary that does not exist).  The TTL bounds how long a change made
+# by another process can go unnoticed if the snapshot generation can't be
+# read.
+vocabulary_cache = Cache('vocabulary', maxsize=64, ttl=300)
+
+# Parsed markup event lists of the dataset sidebar sections, keyed by
+# vocabulary name and sorted tag names.  These never go stale, as they
+# only depend on their key.
+sidebar_cache = Cache('sidebar_fragment', maxsize=1024)
+
+# The tag names of each vocabulary, as returned by the tag_list action (or
+# ``None`` for a vocabulary that does not exist).
+tag_list_cache = Cache('tag_list', maxsize=64, ttl=300)
+
+# Data which only changes when CKAN is redeployed, such as the license
+# options and resource columns.
+static_cache = Cache('static', maxsize=16)
+
+# The built asset files served by ``ExampleController.asset``, by path
+asset_cache = Cache('asset', maxsize=64)
+
+# The home page rendered for anonymous users, by language.  Its TTL is set
+# by ``ckanext.example.home_cache_ttl``, 0 disabling the cache.
+home_page_cache = Cache('home_page', maxsize=16, ttl=60)
+
+_caches = [vocabulary_cache, sidebar_cache, tag_list_cache, static_cache,
+           asset_cache, home_page_cache]
+
+# The caches bounded by the ``ckanext.example.vocab_cache_*`` options.
+_vocabulary_caches = [vocabulary_cache, tag_list_cache]
+
+# The vocabulary caches which ``invalidate_vocabularies`` leaves to their
+# owner to update.
+_updated_in_place = []
+
+
+def register(cache, vocabulary=False, updated_in_place=False):
+    """
+    Adds a cache created elsewhere to those reported by ``stats()``, and
+    to those configured by the vocabulary cache options if
+    ``vocabulary`` is True.  The vocabulary caches are cleared by
+    ``invalidate_vocabularies``, unless ``updated_in_place`` is True
+    because their owner applies the changes of this process itself.
+    """
+    _caches.append(cache)
+    if vocabulary:
+        _vocabulary_caches.append(cache)
+    if updated_in_place:
+        _updated_in_place.append(cache)
+
+
+# The snapshot generation the vocabulary caches were loaded at
+_generation = None
+
+
+def sync():
+    """
+    Drops the cached vocabularies if the snapshot generation has been
+    bumped, by this process or any other, since they were loaded.
+    """
+    global _generation
+    generation = snapshot.store.generation()
+    if generation != _generation:
+        if _generation is not None:
+            _clear_vocabularies()
+        _generation = generation
+
+
+def get_vocabulary(name):
+    """
+    Returns a dict with the ``id`` and ``name`` of the named vocabulary,
+    or None if it doesn't exist.
+    """
+    def _load():
+        try:
+            return snapshot.store.vocabulary(name)
+        except SnapshotUnavailable:
+            pass
+        vocab = model.Vocabulary.get(name)
+        if vocab is None:
+            return None
+        return {'id': vocab.id, 'name': vocab.name}
+    sync()
+    return vocabulary_cache.get_or_create(name, _load)
+
+
+def get_vocabulary_tags(name):
+    """
+    Returns a tuple of the tag names of the named vocabulary, or None if it
+    doesn't exist.
+    """
+    def _load():
+        try:
+            tags = snapshot.store.tags(name)
+            return tags and tuple(tag_name for tag_name, tag_id in tags)
+        except SnapshotUnavailable:
+            pass
+        context = {'model': model, 'session': model.Session}
+        try:
+            return tuple(get_action('tag_list')(context,
+                                                {'vocabulary_id': name}))
+        except NotFound:
+            return None
+    sync()
+    return tag_list_cache.get_or_create(name, _load)
+
+
+def get_static(name, creator):
+    """
+    Returns the value of ``creator()``, computing it once per process.
+    Only use this for data which cannot change while CKAN is running.
+    """
+    return static_cache.get_or_create(name, creator)
+
+
+def get_licence_options():
+    """
+    Returns the ``(title, id)`` pairs of the license options, computed
+    once per host while the snapshot is up to date.
+    """
+    def _load():
+        try:
+            return [tuple(option)
+                    for option in snapshot.store.static('licences')]
+        except SnapshotUnavailable:
+            return model.Package.get_license_options()
+    return get_static('licences', _load)
+
+
+def request_memoize(key, creator):
+    """
+    Returns the value of ``creator()``, computing it once per request for
+    a given ``key``.
+    """
+    memo = request.environ.setdefault('ckanext.example.memo', {})
+    if key not in memo:
+        memo[key] = creator()
+    return memo[key]
+
+
+def _clear_vocabularies():
+    log.debug('Invalidating cached vocabularies')
+    for vocab_cache in _vocabulary_caches:
+        vocab_cache.clear()
+
+
+def invalidate_vocabularies():
+    """
+    Drop everything cached about vocabularies and their tags, in every
+    process.  Called whenever a vocabulary or a tag belonging to one is
+    changed.
+    """
+    global _generation
+    log.debug('Invalidating cached vocabularies')
+    for vocab_cache in _vocabulary_caches:
+        if vocab_cache not in _updated_in_place:
+            vocab_cache.clear()
+    try:
+        generation = snapshot.store.bump()
+    except (IOError, OSError), e:
+        log.warn('Could not bump the vocabulary snapshot generation, '
+                 'other processes will only see the change once their '
+                 'caches expire: %s' % e)
+        return
+    # The caller updates the tag index itself, so keep it unless another
+    # process changed a vocabulary in the meantime.
+    if _generation == generation - 1:
+        _generation = generation
+
+
+def warm_in_background(loaders):
+    """
+    Calls each of ``loaders`` in a background thread, so that the caches
+    they fill are ready for the first requests.  As the model may not be
+    initialised yet when the plugins are configured, failing loaders are
+    retried a few times.  The database connections it used are closed
+    once it is done.
+    """
+    def _warm():
+        try:
+            for attempt in range(5):
+                time.sleep(2 ** attempt)
+                try:
+                    for loader in loaders:
+                        loader()
+                    log.debug('Warmed the vocabulary caches')
+                    return
+                except Exception, e:
+                    error = e
+                finally:
+                    model.Session.remove()
+            log.warn('Could not warm the vocabulary caches: %s' % error)
+        finally:
+            # Servers which load the application before forking their
+            # workers must not let them inherit this thread's pooled
+            # database connections.
+            if model.meta.engine is not None:
+                model.meta.engine.dispose()
+
+    thread = threading.Thread(target=_warm, name='ckanext-example-warm')
+    thread.daemon = True
+    thread.start()
+
+
+def configure(config):
+    """
+    Apply the ``ckanext.example.vocab_cache_*`` and snapshot options from
+    the config.  A ``vocab_cache_ttl`` of 0 keeps entries until they are
+    invalidated.
+    """
+    snapshot.store.configure(config)
+    ttl = asint(config.get('ckanext.example.vocab_cache_ttl', 300)) or None
+    maxsize = asint(config.get('ckanext.example.vocab_cache_size', 64))
+    for vocab_cache in _vocabulary_caches:
+        vocab_cache.configure(maxsize=maxsize, ttl=ttl)
+
+
+def stats():
+    """
+    Returns the statistics of every cache, keyed by cache name.
+    """
+    return dict((c.name, c.stats()) for c in _caches)
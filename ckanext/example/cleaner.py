@@ -0,0 +1,139 @@
+"""
+Batched removal of vocabularies, used by ``paster example clean``.
+
+A vocabulary can have a large number of tags, each used by many datasets,
+so its rows are deleted ``batch_size`` at a time, each batch in its own
+transaction, rather than in one long transaction locking the tag tables.
+Progress is saved to a checkpoint file after every batch, so that an
+interrupted run can be resumed where it stopped.
+"""
+import os
+import json
+import logging
+
+from sqlalchemy import select, func
+
+from ckan import model
+from ckan.model.tag import package_tag_revision_table
+
+import cache
+from tagindex import tag_index
+
+log = logging.getLogger(__name__)
+
+# The tables rows are deleted from, in order.  For each vocabulary being
+# cleaned, the checkpoint records the index of the first table that may
+# still have rows to delete, and the number of rows deleted so far.  It is
+# removed once every vocabulary has been cleaned.
+PHASES = ('package_tag_revision', 'package_tag', 'tag', 'vocabulary')
+
+
+class VocabCleaner(object):
+    """Deletes vocabularies with their tags and package tags.
+    """
+
+    def __init__(self, batch_size=1000, checkpoint=None, dry_run=False):
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self.progress = {}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                self.progress = json.load(f)
+            log.info("Resuming from checkpoint %s" % checkpoint)
+
+    def _save_progress(self):
+        if not self.checkpoint or self.dry_run:
+            return
+        if self.progress:
+            with open(self.checkpoint, 'w') as f:
+                json.dump(self.progress, f)
+        elif os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def _selects(self, vocab_id):
+        """
+        Returns, for each phase, a query of the ids of the rows to delete
+        and the column they are matched on.
+        """
+        tag_ids = select([model.tag_table.c.id])\
+            .where(model.tag_table.c.vocabulary_id == vocab_id)
+        revision = package_tag_revision_table
+        return {
+            'package_tag_revision': (
+                select([revision.c.id])
+                    .where(revision.c.tag_id.in_(tag_ids)),
+                revision.c.id),
+            'package_tag': (
+                select([model.package_tag_table.c.id])
+                    .where(model.package_tag_table.c.tag_id.in_(tag_ids)),
+                model.package_tag_table.c.id),
+            'tag': (tag_ids, model.tag_table.c.id),
+        }
+
+    def count(self, vocab_name):
+        """
+        Returns the number of rows of each table that cleaning the named
+        vocabulary would delete.
+        """
+        vocab = model.Vocabulary.get(vocab_name)
+        if vocab is None:
+            return {}
+        counts = {'vocabulary': 1}
+        for phase, (ids, column) in self._selects(vocab.id).items():
+            counts[phase] = model.Session.execute(
+                select([func.count()]).select_from(ids.alias())).scalar()
+        return counts
+
+    def clean(self, vocab_name):
+        """
+        Deletes the named vocabulary in batches, returning the number of
+        rows deleted from each table.
+        """
+        if self.dry_run:
+            counts = self.count(vocab_name)
+            log.info("Would delete from vocab %s: %r" % (vocab_name, counts))
+            return counts
+
+        state = self.progress.setdefault(vocab_name,
+                                         {'phase': 0, 'deleted': {}})
+        vocab = model.Vocabulary.get(vocab_name)
+        if vocab is None:
+            log.info("Vocab %s does not exist, skipping." % vocab_name)
+            del self.progress[vocab_name]
+            self._save_progress()
+            return state['deleted']
+
+        selects = self._selects(vocab.id)
+        for index, phase in enumerate(PHASES):
+            if index < state['phase']:
+                continue
+            state['phase'] = index
+            if phase == 'vocabulary':
+                model.Session.delete(vocab)
+                model.Session.commit()
+                state['deleted'][phase] = 1
+            else:
+                ids, column = selects[phase]
+                self._delete_batches(phase, ids, column, state)
+        del self.progress[vocab_name]
+        self._save_progress()
+        cache.invalidate_vocabularies()
+        tag_index.drop(vocab_name)
+        log.info("Deleted vocab %s: %r" % (vocab_name, state['deleted']))
+        return state['deleted']
+
+    def _delete_batches(self, phase, ids, column, state):
+        table = column.table
+        while True:
+            batch = [row[0] for row in
+                     model.Session.execute(ids.limit(self.batch_size))]
+            if not batch:
+                break
+            result = model.Session.execute(
+                table.delete().where(column.in_(batch)))
+            model.Session.commit()
+            state['deleted'][phase] = state['deleted'].get(phase, 0) + \
+                result.rowcount
+            self._save_progress()
+            log.info("Deleted %d %s rows" % (state['deleted'][phase], phase))
@@ -1,7 +1,20 @@
+import os
+import sys
+import json
+import time
+import datetime
+
 from ckan import model
 from ckan.lib.cli import CkanCommand
 from ckan.logic import get_action, NotFound
+import assets
+import cleaner
+import exporter
 import forms
+import importer
+import loader
+import profiler
+import userimporter
 
 import logging
 log = logging.getLogger()
@@ -15,14 +28,162 @@ class ExampleCommand(CkanCommand):
 
         paster example create-example-vocabs -c <path to config file>
 
-        paster example clean -c <path to config file>
-            - Remove all data created by ckanext-example
+        paster example load-vocabs <file> [--format=csv|jsonl] [--batch-size=N]
+                                   -c <path to config file>
+            - Add the vocabulary tags listed in a CSV file (with
+              vocabulary,tag columns) or JSON lines file (of
+              {"vocabulary": ..., "tag": ...} objects) which don't exist
+              yet.  Use - as the file name to read standard input.
+
+        paster example import-datasets <file> [--workers=N] [--batch-size=N]
+                                       [--rejects=FILE]
+                                       -c <path to config file>
+            - Create the datasets of a JSON lines file, one dataset dict
+              (as accepted by the example_dataset_form form schema, with
+              published_by, genre_tags and composer_tags) per line.
+              Records are validated by --workers processes (one per CPU
+              by default) and written --batch-size per transaction.
+              Invalid records are written to the rejects file.  Use - as
+              the file name to read standard input.
+
+        paster example import-users <file> [--format=csv|jsonl]
+                                    [--workers=N] [--batch-size=N]
+                                    [--rejects=FILE] [--dry-run]
+                                    -c <path to config file>
+            - Create the users of a CSV file (with a header row naming
+              the fields: name, email, fullname, password, about, ...) or
+              JSON lines file, validated as the user registration form
+              validates them.  Records are validated, and their passwords
+              hashed, by --workers processes, and written --batch-size
+              per transaction.  Invalid records are written, without
+              their passwords, to the rejects file.  --dry-run only
+              validates the records.  Use - as the file name to read
+              standard input.
+
+        paster example export [--output=FILE] [--since=TIMESTAMP]
+                              [--batch-size=N] -c <path to config file>
+            - Write every example dataset, with its published_by extra,
+              vocabulary tags, resources and groups laid out as in the
+              dataset form, as gzipped JSON lines to FILE
+              (example-datasets.jsonl.gz by default).
+              With --since (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS, UTC), only
+              the datasets changed since then are written, including
+              deleted ones.
+
+        paster example clean [<vocab> ...] [--dry-run] [--batch-size=N]
+                             [--checkpoint=FILE] -c <path to config file>
+            - Remove all data created by ckanext-example: the example
+              vocabularies (or the given ones), their tags and their use
+              by datasets.  Rows are deleted in batches of --batch-size,
+              each in its own transaction.  An interrupted run is resumed
+              from the checkpoint file.  --dry-run only reports how many
+              rows would be deleted.
+
+        paster example bench [--datasets=N] [--tags=N] [--page-size=N]
+                             [--repeat=N] [--output=FILE]
+                             -c <path to config file>
+            - Run the extension's benchmarks against a SQLite stand-in
+              database seeded with synthetic data, writing the results
+              as JSON to FILE (or standard output)
+
+        paster example load-test [--users=N] [--duration=SECONDS]
+                                 [--datasets=N] [--tags=N] [--db-url=URL]
+                                 [--baseline=FILE]
+                                 [--max-latency-regression=PERCENT]
+                                 [--max-throughput-regression=PERCENT]
+                                 [--output=FILE] -c <path to config file>
+            - Build the CKAN application from the config file and have
+              --users virtual users request the home, dataset, dataset
+              edit, user registration and user edit pages for --duration
+              seconds, against a SQLite stand-in database (or the empty
+              database at --db-url) seeded with synthetic data.  Prints
+              the throughput and p50/p95/p99 latencies of each page, and
+              writes the full results as JSON to FILE.  With --baseline,
+              exits with status 1 if a latency rose or a throughput fell
+              by more than the given percentage (20 by default) compared
+              with the results in the baseline file, or if any request
+              failed.
+
+        paster example build-assets -c <path to config file>
+            - Bundle and minify the theme's stylesheets, and write the
+              theme's assets with content hashed names and compressed
+              copies to theme/public/dist, with a manifest.  Run it again
+              whenever an asset changes.
+
+        paster example profile-header [--ttl=SECONDS] -c <path to config file>
+            - Print a signed X-Example-Profile header, valid for --ttl
+              seconds, which has the requests sending it profiled (see
+              ckanext.example.profile.secret)
 
     The commands should be run from the ckanext-example directory.
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    def __init__(self, name):
+        super(ExampleCommand, self).__init__(name)
+        self.parser.add_option('--datasets', dest='datasets', type='int',
+                               default=100,
+                               help='Number of synthetic datasets')
+        self.parser.add_option('--tags', dest='tags', type='int',
+                               default=1000,
+                               help='Number of synthetic tags per vocabulary')
+        self.parser.add_option('--page-size', dest='page_size', type='int',
+                               default=1000,
+                               help='Number of items on synthetic pages')
+        self.parser.add_option('--output', dest='output', default=None,
+                               help='File the results are written to')
+        self.parser.add_option('--repeat', dest='repeat', type='int',
+                               default=20,
+                               help='Number of times each benchmark is run')
+        self.parser.add_option('--format', dest='format', default=None,
+                               help='Input format, csv or jsonl (defaults '
+                                    'to the file extension)')
+        self.parser.add_option('--batch-size', dest='batch_size', type='int',
+                               default=1000,
+                               help='Number of rows written per transaction')
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='Report what would be done, without '
+                                    'changing anything')
+        self.parser.add_option('--checkpoint', dest='checkpoint',
+                               default='example-clean.checkpoint',
+                               help='File recording the progress of clean')
+        self.parser.add_option('--workers', dest='workers', type='int',
+                               default=None,
+                               help='Number of worker processes (defaults '
+                                    'to the number of CPUs)')
+        self.parser.add_option('--rejects', dest='rejects', default=None,
+                               help='File the rejected records are '
+                                    'written to (defaults to '
+                                    '<command>.rejects.jsonl)')
+        self.parser.add_option('--since', dest='since', default=None,
+                               help='Only export the datasets changed '
+                                    'since this timestamp')
+        self.parser.add_option('--users', dest='users', type='int',
+                               default=8,
+                               help='Number of concurrent virtual users')
+        self.parser.add_option('--duration', dest='duration', type='int',
+                               default=30,
+                               help='Number of seconds the load test runs')
+        self.parser.add_option('--db-url', dest='db_url', default=None,
+                               help='URL of an empty database to load '
+                                    'test against instead of SQLite')
+        self.parser.add_option('--baseline', dest='baseline', default=None,
+                               help='Load test results to compare with')
+        self.parser.add_option('--max-latency-regression',
+                               dest='max_latency', type='float', default=20,
+                               help='Percentage a latency may rise by '
+                                    'compared with the baseline')
+        self.parser.add_option('--max-throughput-regression',
+                               dest='max_throughput', type='float',
+                               default=20,
+                               help='Percentage a throughput may fall by '
+                                    'compared with the baseline')
+        self.parser.add_option('--ttl', dest='ttl', type='int', default=600,
+                               help='Number of seconds the profile header '
+                                    'is valid for')
+
     def command(self):
         '''
         Parse command line arguments and call appropriate method.
@@ -32,12 +193,33 @@ class ExampleCommand(CkanCommand):
             return
 
         cmd = self.args[0]
+        if cmd in ('bench', 'load-test'):
+            # Keep the plugins loaded with the config from warming their
+            # caches and the shared snapshot, see ``standin.isolate``.
+            import standin
+            standin.isolate()
         self._load_config()
 
         if cmd == 'create-example-vocabs':
             self.create_example_vocabs()
-        if cmd == 'clean':
+        elif cmd == 'load-vocabs':
+            self.load_vocabs()
+        elif cmd == 'import-datasets':
+            self.import_datasets()
+        elif cmd == 'import-users':
+            self.import_users()
+        elif cmd == 'export':
+            self.export()
+        elif cmd == 'clean':
             self.clean()
+        elif cmd == 'bench':
+            self.bench()
+        elif cmd == 'load-test':
+            self.load_test()
+        elif cmd == 'build-assets':
+            self.build_assets()
+        elif cmd == 'profile-header':
+            self.profile_header()
         else:
             log.error('Command "%s" not recognized' % (cmd,))
 
@@ -45,8 +227,7 @@ class ExampleCommand(CkanCommand):
         '''
         Adds example vocabularies to the database if they don't already exist.
         '''
-        user = get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
-        context = {'model': model, 'session': model.Session, 'user': user['name']}
+        context = self._site_user_context()
 
         try:
             data = {'id': forms.GENRE_VOCAB}
@@ -78,5 +259,198 @@ class ExampleCommand(CkanCommand):
             data = {'name': 'Steve Lewis', 'vocabulary_id': vocab['id']}
             get_action('tag_create')(context, data)
 
+    def _site_user_context(self):
+        user = get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+        return {'model': model, 'session': model.Session, 'user': user['name']}
+
+    def _open_input(self):
+        '''
+        Returns the input file named by the second argument and its format.
+        '''
+        if len(self.args) < 2:
+            print ExampleCommand.__doc__
+            sys.exit(1)
+        path = self.args[1]
+        format = self.options.format or \
+            ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        if path == '-':
+            return sys.stdin, format
+        return open(path, 'rb'), format
+
+    def load_vocabs(self):
+        '''
+        Streams vocabulary tags from a file, inserting the missing ones in
+        batches.
+        '''
+        fileobj, format = self._open_input()
+        tag_loader = loader.VocabTagLoader(self._site_user_context(),
+                                           batch_size=self.options.batch_size)
+        try:
+            tag_loader.load(loader.read_rows(fileobj, format))
+        finally:
+            if fileobj is not sys.stdin:
+                fileobj.close()
+
+    def import_datasets(self):
+        '''
+        Creates the datasets of a JSON lines file, validating them in a
+        pool of worker processes.
+        '''
+        fileobj = self._open_input()[0]
+        user = self._site_user_context()['user']
+        rejects_path = self.options.rejects or 'import-datasets.rejects.jsonl'
+        dataset_importer = None
+        try:
+            with open(rejects_path, 'w') as rejects:
+                dataset_importer = importer.DatasetImporter(
+                    user, rejects, workers=self.options.workers,
+                    batch_size=self.options.batch_size)
+                dataset_importer.run(fileobj)
+        finally:
+            if fileobj is not sys.stdin:
+                fileobj.close()
+        if dataset_importer.rejected:
+            log.warn("%d records were rejected, see %s"
+                     % (dataset_importer.rejected, rejects_path))
+
+    def import_users(self):
+        '''
+        Creates the users of a CSV or JSON lines file, validating them and
+        hashing their passwords in a pool of worker processes.
+        '''
+        fileobj, format = self._open_input()
+        user = self._site_user_context()['user']
+        rejects_path = self.options.rejects or 'import-users.rejects.jsonl'
+        user_importer = None
+        try:
+            with open(rejects_path, 'w') as rejects:
+                user_importer = userimporter.UserImporter(
+                    user, rejects, workers=self.options.workers,
+                    batch_size=self.options.batch_size,
+                    dry_run=self.options.dry_run)
+                user_importer.run(userimporter.read_records(fileobj, format))
+        finally:
+            if fileobj is not sys.stdin:
+                fileobj.close()
+        if user_importer.rejected:
+            log.warn("%d records were rejected, see %s"
+                     % (user_importer.rejected, rejects_path))
+
+    def export(self):
+        '''
+        Streams the example datasets to a gzipped JSON lines file.
+        '''
+        since = None
+        if self.options.since:
+            since = exporter.parse_timestamp(self.options.since)
+        path = self.options.output or 'example-datasets.jsonl.gz'
+        started = datetime.datetime.utcnow()
+        batches = exporter.package_batches(self.options.batch_size, since)
+        count = exporter.write_jsonl(exporter.datasets(batches), path)
+        log.info("%d datasets written to %s, export the next changes with "
+                 "--since=%s" % (count, path,
+                                 started.strftime('%Y-%m-%dT%H:%M:%S')))
+
     def clean(self):
-        log.error("Clean command not yet implemented")
+        '''
+        Deletes the example vocabularies, or those named in the arguments,
+        with their tags and package tags.
+        '''
+        vocabs = self.args[1:] or [forms.GENRE_VOCAB, forms.COMPOSER_VOCAB]
+        vocab_cleaner = cleaner.VocabCleaner(
+            batch_size=self.options.batch_size,
+            checkpoint=self.options.checkpoint,
+            dry_run=self.options.dry_run)
+        for vocab in vocabs:
+            vocab_cleaner.clean(unicode(vocab))
+        if not self.options.dry_run:
+            log.info("The search index of datasets which used these tags is "
+                     "now out of date, run 'paster search-index rebuild'.")
+
+    def bench(self):
+        '''
+        Runs the benchmarks in ``bench.py`` and writes their results as
+        JSON.
+        '''
+        import bench
+        from paste.registry import Registry
+        registry = Registry()
+        registry.prepare()
+        results = bench.run_suite(registry,
+                                  datasets=self.options.datasets,
+                                  tags=self.options.tags,
+                                  page_size=self.options.page_size,
+                                  repeat=self.options.repeat)
+        output = json.dumps(results, indent=2)
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(output)
+            log.info("Benchmark results written to %s" % self.options.output)
+        else:
+            print output
+
+    def load_test(self):
+        '''
+        Runs the load test in ``loadtest.py``, and compares its results
+        with the baseline.
+        '''
+        import loadtest
+        import standin
+        from paste.deploy import loadapp
+        app = loadapp('config:%s' % os.path.abspath(self.options.config))
+        # After loading the app, which loads the plugins, so that the one
+        # indexing datasets is unloaded until the test is over and the
+        # seeded datasets never reach the configured search index.
+        database = standin.create(url=self.options.db_url)
+        try:
+            log.info("Seeding the load test database %s" % database)
+            names = standin.seed(datasets=self.options.datasets,
+                                 tags=self.options.tags)
+            loadtest.create_user()
+
+            results = loadtest.LoadTest(
+                app, names, users=self.options.users,
+                duration=self.options.duration).run()
+            results['database'] = database
+            print loadtest.summary(results)
+            if self.options.output:
+                with open(self.options.output, 'w') as f:
+                    json.dump(results, f, indent=2)
+                log.info("Load test results written to %s"
+                         % self.options.output)
+        finally:
+            standin.restore()
+
+        if self.options.baseline:
+            with open(self.options.baseline) as f:
+                baseline = json.load(f)
+            regressions = loadtest.compare(
+                results, baseline,
+                max_latency=self.options.max_latency,
+                max_throughput=self.options.max_throughput)
+            for regression in regressions:
+                log.error(regression)
+            if regressions:
+                sys.exit(1)
+            log.info("No regressions compared with %s"
+                     % self.options.baseline)
+
+    def build_assets(self):
+        '''
+        Builds the fingerprinted assets served by the example plugin.
+        '''
+        manifest = assets.AssetBuilder().build()
+        log.info("Built %d assets in %s, restart CKAN to use them"
+                 % (len(manifest), assets.DIST_DIR))
+
+    def profile_header(self):
+        '''
+        Prints a header requesting a profile of the requests sending it.
+        '''
+        from pylons import config
+        profiler.configure(config)
+        if not profiler.secret:
+            log.error('ckanext.example.profile.secret is not set')
+            sys.exit(1)
+        print '%s: %s' % (profiler.HEADER,
+                          profiler.sign(time.time() + self.options.ttl))
@@ -1,14 +1,26 @@
+import os
 import sys
-from ckan.lib.base import request
+import json
+import mimetypes
+from ckan.lib.base import request, response
+from ckan.lib.base import BaseController, abort
 from ckan.lib.base import c, g, h
 from ckan.lib.base import model
 from ckan.lib.base import render
 from ckan.lib.base import _
+from ckan.lib.base import session
+from pylons.i18n import get_lang
 
 from ckan.lib.navl.validators import not_empty
 
+from ckan.controllers.home import HomeController
 from ckan.controllers.user import UserController
 
+import assets
+import autocomplete
+import cache
+import metrics
+
 
 class CustomUserController(UserController):
     """This controller is an example to show how you might extend or
@@ -21,6 +33,16 @@ class CustomUserController(UserController):
 
     new_user_form = 'user/register.html'
 
+    def register(self, data=None, errors=None, error_summary=None):
+        with metrics.timer('CustomUserController.register'):
+            return super(CustomUserController, self).register(
+                data, errors, error_summary)
+
+    def edit(self, id=None, data=None, errors=None, error_summary=None):
+        with metrics.timer('CustomUserController.edit'):
+            return super(CustomUserController, self).edit(
+                id, data, errors, error_summary)
+
     def _add_requires_full_name_to_schema(self, schema):
         """
         Helper function that modifies the fullname validation on an existing schema
@@ -50,3 +72,88 @@ class CustomUserController(UserController):
         self._add_requires_full_name_to_schema(schema)
         return schema
 
+
+class ExampleHomeController(HomeController):
+    """Serves the home page to anonymous users from a cache, for the
+    ``ckanext.example.home_cache_ttl`` seconds after it was rendered.
+
+    Logged in users, and pages showing a flash message, are always
+    rendered, as they differ from one request to the next.
+    """
+
+    def index(self):
+        if not cache.home_page_cache.ttl or c.user or session.get('flash'):
+            return super(ExampleHomeController, self).index()
+        return cache.home_page_cache.get_or_create(
+            tuple(get_lang() or ()),
+            lambda: super(ExampleHomeController, self).index())
+
+
+class ExampleController(BaseController):
+    """Serves information about the running extension itself.
+    """
+
+    def cache_stats(self):
+        """
+        Returns the hit and miss counters of the extension's caches in
+        this process as JSON.
+        """
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        return json.dumps(cache.stats())
+
+    def metrics(self):
+        """
+        Returns the latency histograms of the plugins' hooks and the cache
+        counters in this process, in the Prometheus text format.
+        """
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return metrics.render()
+
+    def tag_autocomplete(self, vocab):
+        """
+        Returns, as JSON, the tags of the ``vocab`` vocabulary which start
+        with the ``q`` parameter, ignoring case, in alphabetical order:
+        ``limit`` of them (at most ``autocomplete.MAX_LIMIT``) from the
+        ``offset``th one.
+        """
+        try:
+            offset = max(int(request.params.get('offset', 0)), 0)
+            limit = min(max(int(request.params.get('limit', 20)), 1),
+                        autocomplete.MAX_LIMIT)
+        except ValueError:
+            abort(400, _('offset and limit must be integers'))
+        prefix = request.params.get('q', u'')
+        result = autocomplete.search(vocab, prefix, offset, limit)
+        if result is None:
+            abort(404, _('Vocabulary not found'))
+        tags, more = result
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        return json.dumps({'vocabulary': vocab, 'q': prefix,
+                           'offset': offset, 'limit': limit,
+                           'tags': tags, 'more': more})
+
+    def asset(self, filename):
+        """
+        Serves a fingerprinted asset built by ``paster example
+        build-assets``, at the URL earlier builds linked to (the plugin
+        now links to the static copy, see ``assets.py``).  As its name
+        changes with its content, it can be cached for as long as browsers
+        allow.  The precompressed copy is sent to the browsers which
+        accept it.
+        """
+        path = assets.path(filename)
+        if path is None:
+            abort(404)
+        accepted = assets.accepted_encoding(
+            request.headers.get('Accept-Encoding'))
+        if accepted is not None and os.path.exists(path + accepted[1]):
+            response.headers['Content-Encoding'] = accepted[0]
+            path += accepted[1]
+        content_type = mimetypes.guess_type(filename)[0]
+        response.headers['Content-Type'] = \
+            content_type or 'application/octet-stream'
+        response.headers['Cache-Control'] = \
+            'public, max-age=31536000, immutable'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return cache.asset_cache.get_or_create(
+            path, lambda: open(path, 'rb').read())
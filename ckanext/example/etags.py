@@ -0,0 +1,57 @@
+"""
+Conditional GET support for the dataset pages decorated by the extension.
+
+The dataset page only changes when the dataset does (any of its related
+revisions), when a vocabulary changes (the snapshot generation, see
+``snapshot.py``), or when the theme's assets do (the asset manifest, see
+``assets.py``), for a given user and language.  Its ETag is a hash of
+these, checked as soon as the dataset is read by ``package_show``, so that
+a matching ``If-None-Match`` is answered with 304 Not Modified before the
+page is rendered and filtered.
+"""
+import hashlib
+
+from pylons import request, tmpl_context as c
+from pylons.controllers.util import etag_cache
+from pylons.i18n import get_lang
+
+import assets
+import snapshot
+
+# The routes whose pages are answered with an ETag
+ROUTES = [('package', 'read')]
+
+
+def package_etag(pkg):
+    """
+    Returns the ETag of the page of the ``pkg`` dataset for the current
+    user and language.
+    """
+    revision = pkg.latest_related_revision
+    parts = [pkg.id,
+             revision.id if revision else pkg.revision_id,
+             str(snapshot.store.generation()),
+             assets.manifest_hash(),
+             c.user or '',
+             ','.join(get_lang() or ())]
+    return hashlib.sha1(
+        u'|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def check_package(pkg):
+    """
+    Sets the ETag of the dataset page being requested, and aborts with 304
+    Not Modified if the client already has it.  Does nothing for other
+    requests, such as API calls.
+    """
+    try:
+        environ = request.environ
+    except TypeError:
+        # Not in a request, e.g. running a paster command
+        return
+    if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+        return
+    routes = environ.get('pylons.routes_dict') or {}
+    if (routes.get('controller'), routes.get('action')) not in ROUTES:
+        return
+    etag_cache(package_etag(pkg))
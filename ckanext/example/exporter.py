@@ -0,0 +1,235 @@
+"""
+Streaming export of the example datasets, used by ``paster example
+export``.
+
+The datasets are read with a server-side cursor, ``batch_size`` rows at a
+time, and the tags, extras, resources and groups of each batch are
+fetched with one query each.  Every stage is a generator, so only one
+batch is held in memory whatever the size of the catalogue.  Datasets are
+written as gzipped JSON lines laid out as
+``ExampleDatasetForm.db_to_form_schema`` returns them: the vocabulary tags
+in ``genre_tags_selected`` and ``composer_tags_selected``, the
+``published_by`` extra as a field, only the free tags in ``tags``, the
+active resources in ``resources``, in order, with their extras as fields,
+and the ``id``, ``name`` and ``title`` of the dataset's groups in
+``groups``.
+"""
+import gzip
+import json
+import time
+import datetime
+import logging
+
+from sqlalchemy import select, union, and_
+
+from ckan import model
+from ckan.model.package import package_revision_table
+from ckan.model.package_extra import extra_revision_table
+from ckan.model.tag import package_tag_revision_table
+from ckan.model.resource import resource_revision_table
+from ckan.model.group import member_revision_table
+
+import cache
+from forms import ExampleDatasetForm, GENRE_VOCAB, COMPOSER_VOCAB
+
+log = logging.getLogger(__name__)
+
+# The db_to_form_schema fields each vocabulary's tags are exported in
+VOCAB_FIELDS = ((GENRE_VOCAB, 'genre_tags_selected'),
+                (COMPOSER_VOCAB, 'composer_tags_selected'))
+
+# Extras exported as fields of their own
+EXTRA_FIELDS = ('published_by',)
+
+
+def parse_timestamp(value):
+    """
+    Parses a ``YYYY-MM-DD`` or ``YYYY-MM-DDTHH:MM:SS`` timestamp.
+    """
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp "%s"' % value)
+
+
+def _changed_since(since):
+    """
+    Returns a query of the ids of the packages whose fields, extras, tags,
+    resources or groups have been changed in a revision made since
+    ``since``.
+    """
+    revisions = select([model.revision_table.c.id])\
+        .where(model.revision_table.c.timestamp >= since)
+    return union(
+        select([package_revision_table.c.continuity_id])
+            .where(package_revision_table.c.revision_id.in_(revisions)),
+        select([extra_revision_table.c.package_id])
+            .where(extra_revision_table.c.revision_id.in_(revisions)),
+        select([package_tag_revision_table.c.package_id])
+            .where(package_tag_revision_table.c.revision_id.in_(revisions)),
+        select([model.resource_group_table.c.package_id])
+            .where(model.resource_group_table.c.id.in_(
+                select([resource_revision_table.c.resource_group_id])
+                    .where(resource_revision_table.c.revision_id.in_(
+                        revisions)))),
+        select([member_revision_table.c.table_id])
+            .where(and_(member_revision_table.c.table_name == 'package',
+                        member_revision_table.c.revision_id.in_(revisions))),
+    )
+
+
+def package_batches(batch_size=1000, since=None):
+    """
+    Yields the rows of the example datasets, in lists of ``batch_size``
+    dicts, read with a server-side cursor.
+
+    Only active datasets are exported, unless ``since`` is given: then
+    every dataset changed since then is, whatever its state, so that
+    deletions are exported too.
+    """
+    package = model.package_table
+    dataset_type = ExampleDatasetForm().package_types()[0]
+    query = select([package]).where(package.c.type == dataset_type)
+    if since is None:
+        query = query.where(package.c.state == model.State.ACTIVE)
+    else:
+        query = query.where(package.c.id.in_(_changed_since(since)))
+    query = query.order_by(package.c.name)
+
+    connection = model.meta.engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True)\
+            .execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [dict(row) for row in rows]
+    finally:
+        connection.close()
+
+
+def _tags(package_ids):
+    package_tag, tag = model.package_tag_table, model.tag_table
+    query = select([package_tag.c.package_id, tag.c.name,
+                    tag.c.vocabulary_id])\
+        .select_from(package_tag.join(tag,
+                                      tag.c.id == package_tag.c.tag_id))\
+        .where(and_(package_tag.c.package_id.in_(package_ids),
+                    package_tag.c.state == model.State.ACTIVE))\
+        .order_by(tag.c.name)
+    return model.Session.execute(query)
+
+
+def _extras(package_ids):
+    extra = model.package_extra_table
+    query = select([extra.c.package_id, extra.c.key, extra.c.value])\
+        .where(and_(extra.c.package_id.in_(package_ids),
+                    extra.c.state == model.State.ACTIVE))\
+        .order_by(extra.c.key)
+    return model.Session.execute(query)
+
+
+def _resources(package_ids):
+    resource_group, resource = model.resource_group_table, \
+        model.resource_table
+    query = select([resource_group.c.package_id, resource])\
+        .select_from(resource.join(
+            resource_group,
+            resource_group.c.id == resource.c.resource_group_id))\
+        .where(and_(resource_group.c.package_id.in_(package_ids),
+                    resource_group.c.state == model.State.ACTIVE,
+                    resource.c.state == model.State.ACTIVE))\
+        .order_by(resource.c.position)
+    return model.Session.execute(query)
+
+
+def _groups(package_ids):
+    member, group = model.member_table, model.group_table
+    query = select([member.c.table_id, group.c.id, group.c.name,
+                    group.c.title])\
+        .select_from(member.join(group, group.c.id == member.c.group_id))\
+        .where(and_(member.c.table_id.in_(package_ids),
+                    member.c.table_name == 'package',
+                    member.c.state == model.State.ACTIVE,
+                    group.c.state == model.State.ACTIVE))\
+        .order_by(group.c.name)
+    return model.Session.execute(query)
+
+
+def datasets(batches):
+    """
+    Yields the dataset dicts of each batch of package rows, with their
+    tags, extras, resources and groups.
+    """
+    vocab_fields = {}
+    for vocab_name, field in VOCAB_FIELDS:
+        vocab = cache.get_vocabulary(vocab_name)
+        if vocab is not None:
+            vocab_fields[vocab['id']] = field
+
+    for rows in batches:
+        by_id = {}
+        for row in rows:
+            row['tags'] = []
+            row['extras'] = []
+            row['resources'] = []
+            row['groups'] = []
+            for vocab_name, field in VOCAB_FIELDS:
+                row[field] = []
+            by_id[row['id']] = row
+        ids = by_id.keys()
+
+        for package_id, name, vocabulary_id in _tags(ids):
+            if vocabulary_id is None:
+                by_id[package_id]['tags'].append({'name': name})
+            elif vocabulary_id in vocab_fields:
+                by_id[package_id][vocab_fields[vocabulary_id]].append(name)
+        for package_id, key, value in _extras(ids):
+            if key in EXTRA_FIELDS:
+                by_id[package_id][key] = value
+            else:
+                by_id[package_id]['extras'].append({'key': key,
+                                                    'value': value})
+        for resource in _resources(ids):
+            resource = dict(resource)
+            package_id = resource.pop('package_id')
+            del resource['resource_group_id']
+            # As package_dictize does, the extras are fields of their own
+            resource.update(resource.pop('extras', None) or {})
+            by_id[package_id]['resources'].append(resource)
+        for package_id, group_id, name, title in _groups(ids):
+            by_id[package_id]['groups'].append(
+                {'id': group_id, 'name': name, 'title': title})
+        model.Session.remove()
+
+        for row in rows:
+            yield row
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def write_jsonl(records, path):
+    """
+    Writes each record as a line of JSON to a gzipped file, and returns
+    the number of records written.
+    """
+    count = 0
+    started = time.time()
+    output = gzip.open(path, 'wb')
+    try:
+        for record in records:
+            output.write(json.dumps(record, default=_default) + '\n')
+            count += 1
+            if count % 10000 == 0:
+                log.info("%d datasets exported (%.0f datasets/s)" % (
+                    count, count / max(time.time() - started, 0.001)))
+    finally:
+        output.close()
+    return count
@@ -1,35 +1,114 @@
 import os
 import logging
+import functools
+import itertools
+from genshi.core import Stream, escape
+from genshi.input import HTML
+from paste.deploy.converters import asbool
 from ckan.authz import Authorizer
 from ckan.logic.converters import convert_to_extras,\
-    convert_from_extras, convert_to_tags, convert_from_tags, free_tags_only
-from ckan.logic import get_action, NotFound
+    convert_from_extras, free_tags_only
 from ckan.logic.schema import package_form_schema, group_form_schema
 from ckan.lib.base import c, model
 from ckan.plugins import IDatasetForm, IGroupForm, IConfigurer
-from ckan.plugins import IGenshiStreamFilter
+from ckan.plugins import IConfigurable
+from ckan.plugins import IGenshiStreamFilter, IActions, IPackageController
 from ckan.plugins import implements, SingletonPlugin
 from ckan.lib.navl.validators import ignore_missing, keep_extras, not_empty
 import ckan.lib.plugins
 
+import actions
+import cache
+import etags
+import metrics
+import snapshot
+import templates
+from converters import convert_to_tags, convert_from_tags,\
+    vocabulary_id_exists
+from schemas import cached_schema
+from tagindex import tag_index
+from transforms import StreamRules
+
 log = logging.getLogger(__name__)
 
 GENRE_VOCAB = u'genre_vocab'
 COMPOSER_VOCAB = u'composer_vocab'
 
+# Headings of the dataset sidebar sections listing each vocabulary's tags.
+VOCAB_HEADINGS = {
+    GENRE_VOCAB: 'Musical Genre',
+    COMPOSER_VOCAB: 'Composer',
+}
+
+
+def vocab_sidebar_section(vocab_name, tag_names):
+    """
+    Returns a stream of the sidebar section listing the given tags of a
+    vocabulary.
+
+    The parsed markup is cached by vocabulary and set of tags, so datasets
+    sharing the same tags reuse it without building or parsing any HTML.
+    """
+    key = (vocab_name, tuple(sorted(tag_names)))
+
+    def _build():
+        html = ['<li class="sidebar-section">']
+        if vocab_name in VOCAB_HEADINGS:
+            html.append('<h3>%s</h3>' % VOCAB_HEADINGS[vocab_name])
+        html.append('<ul class="tags clearfix">')
+        for tag_name in key[1]:
+            html.append('<li>%s</li>' % escape(tag_name, quotes=False))
+        html.append('</ul></li>')
+        return list(HTML(u''.join(html)))
+
+    return Stream(cache.sidebar_cache.get_or_create(key, _build))
+
+
+# The stream transformations applied by ``ExampleDatasetForm.filter``, each
+# only on the routes it is registered for.
+stream_rules = StreamRules()
+
+
+def vocab_tags_sidebar():
+    """
+    Returns the sidebar sections listing the dataset's vocab tags, or None
+    if it has none.
+    """
+    sections = []
+    for vocab in (GENRE_VOCAB, COMPOSER_VOCAB):
+        vocab = cache.get_vocabulary(vocab)
+        if vocab is None:
+            continue
+        vocab_tags = [t['name'] for t in c.pkg_dict.get('tags', [])
+                      if t.get('vocabulary_id') == vocab['id']]
+        if vocab_tags:
+            sections.append(vocab_sidebar_section(vocab['name'], vocab_tags))
+    if not sections:
+        return None
+    return list(itertools.chain(*sections))
+
+
+# Add the dataset's vocab tags to the bottom of the sidebar.
+stream_rules.append([('package', 'read')],
+                    "//div[@id='sidebar']//ul[@class='widget-list']",
+                    vocab_tags_sidebar)
+
 
 class ExampleGroupForm(SingletonPlugin):
     """This plugin demonstrates how a class packaged as a CKAN
     extension might extend CKAN behaviour by providing custom forms
     based on the type of a Group.
 
-    In this case, we implement two extension interfaces to provide custom
-    forms for specific types of group.
+    In this case, we implement three extension interfaces to provide
+    custom forms for specific types of group.
 
       - ``IConfigurer`` allows us to override configuration normally
         found in the ``ini``-file.  Here we use it to specify where the
         form templates can be found.
 
+      - ``IConfigurable`` is called once CKAN is configured.  We use it
+        to look up our templates in an index rather than on disk.
+
       - ``IGroupForm`` allows us to provide a custom form for a dataset
         based on the 'type' that may be set for a group.  Where the
         'type' matches one of the values in group_types then this
@@ -37,6 +116,7 @@ class ExampleGroupForm(SingletonPlugin):
     """
     implements(IGroupForm, inherit=True)
     implements(IConfigurer, inherit=True)
+    implements(IConfigurable, inherit=True)
 
     def update_config(self, config):
         """
@@ -47,8 +127,13 @@ class ExampleGroupForm(SingletonPlugin):
         rootdir = os.path.dirname(os.path.dirname(here))
         template_dir = os.path.join(rootdir, 'ckanext',
                                     'example', 'theme', 'templates')
-        config['extra_template_paths'] = ','.join([template_dir,
-                config.get('extra_template_paths', '')])
+        templates.add_template_paths(config, template_dir)
+
+    def configure(self, config):
+        """
+        Looks up our templates in an index built at startup.
+        """
+        templates.install(config)
 
     def group_form(self):
         """
@@ -80,6 +165,7 @@ class ExampleGroupForm(SingletonPlugin):
         """
         return False
 
+    @cached_schema
     def form_to_db_schema(self):
         """
         Returns the schema for mapping group data from a form to a format
@@ -87,6 +173,7 @@ class ExampleGroupForm(SingletonPlugin):
         """
         return group_form_schema()
 
+    @cached_schema
     def db_to_form_schema(self):
         """
         Returns the schema for mapping group data from the database into a
@@ -111,19 +198,29 @@ class ExampleDatasetForm(SingletonPlugin, ckan.lib.plugins.DefaultDatasetForm):
     """This plugin demonstrates how a theme packaged as a CKAN
     extension might extend CKAN behaviour.
 
-    In this case, we implement three extension interfaces:
+    In this case, we implement six extension interfaces:
 
       - ``IConfigurer`` allows us to override configuration normally
         found in the ``ini``-file.  Here we use it to specify where the
         form templates can be found.
+      - ``IConfigurable`` is called once CKAN is configured.  We use it
+        to look up our templates in an index rather than on disk.
       - ``IDatasetForm`` allows us to provide a custom form for a dataset
         based on the type_name that may be set for a package.  Where the
         type_name matches one of the values in package_types then this
         class will be used.
+      - ``IActions`` allows us to wrap the core vocabulary and tag
+        actions, so that our cached vocabularies are invalidated
+        whenever they change.
+      - ``IPackageController`` allows us to answer repeat views of a
+        dataset page with 304 Not Modified, before it is rendered.
     """
     implements(IDatasetForm, inherit=True)
     implements(IConfigurer, inherit=True)
+    implements(IConfigurable, inherit=True)
     implements(IGenshiStreamFilter, inherit=True)
+    implements(IActions, inherit=True)
+    implements(IPackageController, inherit=True)
 
     def update_config(self, config):
         """
@@ -134,8 +231,37 @@ class ExampleDatasetForm(SingletonPlugin, ckan.lib.plugins.DefaultDatasetForm):
         rootdir = os.path.dirname(os.path.dirname(here))
         template_dir = os.path.join(rootdir, 'ckanext',
                                     'example', 'theme', 'templates')
-        config['extra_template_paths'] = ','.join([template_dir,
-                config.get('extra_template_paths', '')])
+        templates.add_template_paths(config, template_dir)
+        cache.configure(config)
+        # load the shared snapshot and our caches before the first request
+        if asbool(config.get('ckanext.example.warm_caches', True)):
+            cache.warm_in_background([
+                snapshot.store.ensure,
+                cache.get_licence_options,
+            ] + [functools.partial(loader, vocab_name)
+                 for vocab_name in VOCAB_HEADINGS
+                 for loader in (cache.get_vocabulary_tags,
+                                tag_index.vocabulary)])
+
+    def configure(self, config):
+        """
+        Looks up our templates in an index built at startup.
+        """
+        templates.install(config)
+
+    def get_actions(self):
+        """
+        Returns the vocabulary and tag actions wrapped to invalidate the
+        vocabulary cache.
+        """
+        return actions.get_actions()
+
+    def read(self, entity):
+        """
+        Called by ``package_show``: sets the ETag of the dataset page, and
+        stops with 304 Not Modified if the client has it already.
+        """
+        etags.check_package(entity)
 
     def package_form(self):
         """
@@ -167,28 +293,32 @@ class ExampleDatasetForm(SingletonPlugin, ckan.lib.plugins.DefaultDatasetForm):
         """
         return ["example_dataset_form"]
 
+    @metrics.timed('ExampleDatasetForm.setup_template_variables')
     def setup_template_variables(self, context, data_dict=None):
         """
         Adds variables to c just prior to the template being rendered that can
         then be used within the form
         """
-        c.licences = [('', '')] + model.Package.get_license_options()
+        c.licences = [('', '')] + cache.get_licence_options()
         c.publishers = [('Example publisher', 'Example publisher 2')]
-        c.is_sysadmin = Authorizer().is_sysadmin(c.user)
-        c.resource_columns = model.Resource.get_columns()
-        try:
-            c.genre_tags = get_action('tag_list')(context, {'vocabulary_id': GENRE_VOCAB})
-            c.composer_tags = get_action('tag_list')(context, {'vocabulary_id': COMPOSER_VOCAB})
-        except NotFound:
-            c.vocab_tags = None
-            c.composer_tags = None
+        c.is_sysadmin = cache.request_memoize(('is_sysadmin', c.user), lambda:
+            Authorizer().is_sysadmin(c.user))
+        c.resource_columns = cache.get_static('resource_columns',
+                                              model.Resource.get_columns)
+        # Only the selected tags are rendered, the form fetches the others
+        # from ``ExampleController.tag_autocomplete`` as the user types.
+        c.genre_vocab = cache.get_vocabulary(GENRE_VOCAB)
+        c.composer_vocab = cache.get_vocabulary(COMPOSER_VOCAB)
 
         ## This is messy as auths take domain object not data_dict
         pkg = context.get('package') or c.pkg
         if pkg:
-            c.auth_for_change_state = Authorizer().am_authorized(
-                c, model.Action.CHANGE_STATE, pkg)
+            c.auth_for_change_state = cache.request_memoize(
+                ('change_state', c.user, pkg.id), lambda:
+                Authorizer().am_authorized(c, model.Action.CHANGE_STATE, pkg))
 
+    @metrics.timed('ExampleDatasetForm.form_to_db_schema')
+    @cached_schema
     def form_to_db_schema(self):
         """
         Returns the schema for mapping package data from a form to a format
@@ -200,8 +330,12 @@ class ExampleDatasetForm(SingletonPlugin, ckan.lib.plugins.DefaultDatasetForm):
             'genre_tags': [ignore_missing, convert_to_tags(GENRE_VOCAB)],
             'composer_tags': [ignore_missing, convert_to_tags(COMPOSER_VOCAB)]
         })
+        schema['tags']['vocabulary_id'] = [ignore_missing, unicode,
+                                           vocabulary_id_exists]
         return schema
 
+    @metrics.timed('ExampleDatasetForm.db_to_form_schema')
+    @cached_schema
     def db_to_form_schema(self):
         """
         Returns the schema for mapping package data from the database into a
@@ -233,35 +367,8 @@ class ExampleDatasetForm(SingletonPlugin, ckan.lib.plugins.DefaultDatasetForm):
         return
 
     def filter(self, stream):
-        # Add vocab tags to the bottom of the sidebar.
-        from pylons import request
-        from genshi.filters import Transformer
-        from genshi.input import HTML
-        routes = request.environ.get('pylons.routes_dict')
-        context = {'model': model}
-        if routes.get('controller') == 'package' \
-            and routes.get('action') == 'read':
-                for vocab in (GENRE_VOCAB, COMPOSER_VOCAB):
-                    try:
-                        vocab = get_action('vocabulary_show')(context, {'id': vocab})
-                        vocab_tags = [t for t in c.pkg_dict.get('tags', [])
-                                      if t.get('vocabulary_id') == vocab['id']]
-                    except NotFound:
-                        vocab_tags = None
-
-                    if not vocab_tags:
-                        continue
-
-                    html = '<li class="sidebar-section">'
-                    if vocab['name'] == GENRE_VOCAB:
-                        html = html + '<h3>Musical Genre</h3>'
-                    elif vocab['name'] == COMPOSER_VOCAB:
-                        html = html + '<h3>Composer</h3>'
-                    html = html + '<ul class="tags clearfix">'
-                    for tag in vocab_tags:
-                        html = html + '<li>%s</li>' % tag['name']
-                    html = html + "</ul></li>"
-                    stream = stream | Transformer(
-                        "//div[@id='sidebar']//ul[@class='widget-list']"
-                    ).append(HTML(html))
-        return stream
+        """
+        Applies the stream rules registered for the current route.
+        """
+        return stream_rules.apply(
+            stream, metrics.timer_if_enabled('ExampleDatasetForm.filter'))
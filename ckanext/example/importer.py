@@ -0,0 +1,221 @@
+"""
+Parallel bulk import of datasets, used by ``paster example
+import-datasets``.
+
+Records are read from a JSON lines file ``batch_size`` at a time, so
+memory use does not grow with the size of the input.  Each batch is
+parsed and validated against ``ExampleDatasetForm.form_to_db_schema`` by
+a pool of worker processes, while the previous batch is written by the
+parent process in a single transaction.  The vocabulary tag index (see
+``tagindex.py``) is loaded before the workers are forked, so they
+resolve the genre and composer tags without querying the database.
+
+Records which fail to parse, validate or save are written to a reject
+file, one JSON object per line with the line number, the record and the
+errors.
+"""
+import json
+import time
+import logging
+import multiprocessing
+
+from ckan import model
+from ckan.lib.navl.dictization_functions import validate
+from ckan.lib.dictization import model_save
+from ckan.plugins import PluginImplementations, IPackageController
+
+from forms import ExampleDatasetForm, GENRE_VOCAB, COMPOSER_VOCAB
+from tagindex import tag_index
+
+log = logging.getLogger(__name__)
+
+# Largest number of names looked up in the database with one query
+QUERY_SIZE = 500
+
+# The context and schema used by ``validate_line``, set in each worker
+_context = None
+_schema = None
+
+
+def _init_validation(user):
+    global _context, _schema
+    _context = {'model': model, 'session': model.Session, 'user': user}
+    _schema = ExampleDatasetForm().form_to_db_schema()
+
+
+def validate_line(numbered_line):
+    """
+    Parses and validates a ``(line number, line)`` pair, returning the
+    line number, the line, the validated data and the errors.
+    """
+    number, line = numbered_line
+    try:
+        record = json.loads(line)
+    except ValueError, e:
+        return number, line, None, {'json': [str(e)]}
+    if not isinstance(record, dict):
+        return number, line, None, {'json': ['Not a JSON object']}
+    record.setdefault('type', ExampleDatasetForm().package_types()[0])
+    try:
+        data, errors = validate(record, _schema, _context)
+    finally:
+        model.Session.remove()
+    return number, line, data, errors
+
+
+class DatasetImporter(object):
+    """Imports the datasets of a JSON lines file, validating them in
+    ``workers`` processes and writing them ``batch_size`` at a time.
+    """
+
+    def __init__(self, user, rejects, workers=None, batch_size=1000):
+        self.user = user
+        self.rejects = rejects
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.rows = 0
+        self.imported = 0
+        self.rejected = 0
+        self._admins = None
+        self._started = None
+
+    def _batches(self, fileobj):
+        batch = []
+        for number, line in enumerate(fileobj, 1):
+            if not line.strip():
+                continue
+            batch.append((number, line))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _reject(self, number, line, errors):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = line.rstrip('\n')
+        self.rejects.write(json.dumps({'line': number, 'record': record,
+                                       'errors': errors}) + '\n')
+        self.rejected += 1
+
+    def _save(self, data):
+        pkg = model_save.package_dict_save(data, {
+            'model': model, 'session': model.Session, 'user': self.user})
+        if self._admins is None:
+            self._admins = [model.User.by_name(self.user)]
+        model.setup_default_user_roles(pkg, self._admins)
+        for item in PluginImplementations(IPackageController):
+            item.create(pkg)
+
+    def _new_revision(self):
+        rev = model.repo.new_revision()
+        rev.author = self.user
+        rev.message = u'Imported by paster example import-datasets'
+
+    def _in_use(self, names):
+        """
+        Returns those of ``names`` which a dataset already has.
+        """
+        names = list(names)
+        in_use = set()
+        for start in range(0, len(names), QUERY_SIZE):
+            query = model.Session.query(model.Package.name).filter(
+                model.Package.name.in_(names[start:start + QUERY_SIZE]))
+            in_use.update(name for (name,) in query)
+        return in_use
+
+    def _write(self, results):
+        """
+        Writes the valid records of a batch in one transaction, falling
+        back to one transaction per record if it fails.
+        """
+        valid = []
+        names = set()
+        for number, line, data, errors in results:
+            self.rows += 1
+            if errors:
+                self._reject(number, line, errors)
+            elif data['name'] in names:
+                self._reject(number, line,
+                             {'name': ['Duplicate of an earlier record']})
+            else:
+                names.add(data['name'])
+                valid.append((number, line, data))
+        # A batch is validated while the previous one is being written, so
+        # its names are checked again against the datasets written since.
+        in_use = self._in_use(names)
+        for number, line, data in valid:
+            if data['name'] in in_use:
+                self._reject(number, line,
+                             {'name': ['That URL is already in use.']})
+        valid = [record for record in valid
+                 if record[2]['name'] not in in_use]
+
+        try:
+            self._new_revision()
+            for number, line, data in valid:
+                self._save(data)
+            model.repo.commit()
+            self.imported += len(valid)
+        except Exception, e:
+            model.Session.rollback()
+            log.warn('Writing the batch failed (%s), writing its records '
+                     'one at a time' % e)
+            for number, line, data in valid:
+                try:
+                    self._new_revision()
+                    self._save(data)
+                    model.repo.commit()
+                    self.imported += 1
+                except Exception, e:
+                    model.Session.rollback()
+                    self._reject(number, line, {'database': [str(e)]})
+        model.Session.remove()
+        self._admins = None
+
+        elapsed = time.time() - self._started
+        log.info("%d records read, %d imported, %d rejected "
+                 "(%.0f records/s)" % (self.rows, self.imported,
+                                       self.rejected,
+                                       self.rows / max(elapsed, 0.001)))
+
+    def run(self, fileobj):
+        """
+        Imports the datasets of a file of JSON lines.
+        """
+        self._started = time.time()
+        # Load everything the workers share before forking them, and
+        # don't let them inherit the parent's database connections.
+        _init_validation(self.user)
+        for vocab_name in (GENRE_VOCAB, COMPOSER_VOCAB):
+            tag_index.vocabulary(vocab_name)
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        if self.workers <= 1:
+            for batch in self._batches(fileobj):
+                self._write(map(validate_line, batch))
+            return
+
+        pool = multiprocessing.Pool(self.workers, _init_validation,
+                                    (self.user,))
+        try:
+            chunksize = max(1, self.batch_size / (self.workers * 4))
+            pending = None
+            # Validate the next batch while writing the current one
+            for batch in self._batches(fileobj):
+                validating = pool.map_async(validate_line, batch, chunksize)
+                if pending is not None:
+                    self._write(pending.get())
+                pending = validating
+            if pending is not None:
+                self._write(pending.get())
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
@@ -0,0 +1,119 @@
+"""
+Bulk loading of vocabulary tags, used by ``paster example load-vocabs``.
+
+Creating tags one ``tag_create`` call at a time commits once per tag,
+which is far too slow for vocabularies with tens of thousands of entries.
+Here the input is streamed row by row, the tags already in each
+vocabulary are fetched with a single query the first time it is seen,
+and only the missing tags are inserted, ``batch_size`` at a time in one
+transaction per batch.
+"""
+import csv
+import json
+import time
+import logging
+
+from ckan import model
+from ckan.logic import get_action
+from ckan.logic.validators import tag_length_validator, tag_name_validator
+from ckan.lib.navl.dictization_functions import Invalid
+
+import cache
+from tagindex import tag_index
+
+log = logging.getLogger(__name__)
+
+
+def read_rows(fileobj, format='csv'):
+    """
+    Yields ``(vocabulary name, tag name)`` pairs from a CSV file with
+    ``vocabulary,tag`` columns (the header row is optional) or from a
+    JSON lines file of ``{"vocabulary": ..., "tag": ...}`` objects.
+    """
+    if format == 'jsonl':
+        for line in fileobj:
+            line = line.strip()
+            if line:
+                row = json.loads(line)
+                yield row['vocabulary'], row['tag']
+    elif format == 'csv':
+        for row in csv.reader(fileobj):
+            if not row or row == ['vocabulary', 'tag']:
+                continue
+            yield row[0].decode('utf-8'), row[1].decode('utf-8')
+    else:
+        raise ValueError('Unknown input format "%s"' % format)
+
+
+class VocabTagLoader(object):
+    """Inserts the tags of the rows it is given which don't exist yet.
+    """
+
+    def __init__(self, context, batch_size=1000):
+        self.context = context
+        self.batch_size = batch_size
+        self.rows = 0
+        self.inserted = 0
+        self.rejected = 0
+        self._pending = 0
+        self._started = None
+        # vocabulary name -> (vocabulary id, set of its tag names)
+        self._vocabs = {}
+
+    def _vocabulary(self, name):
+        if name not in self._vocabs:
+            vocab = model.Vocabulary.get(name)
+            if vocab is None:
+                log.info("Creating vocab %s" % name)
+                vocab_id = get_action('vocabulary_create')(
+                    self.context, {'name': name})['id']
+            else:
+                vocab_id = vocab.id
+            query = model.Session.query(model.Tag.name)\
+                .filter(model.Tag.vocabulary_id == vocab_id)
+            self._vocabs[name] = (vocab_id, set(n for (n,) in query))
+            log.info("Vocab %s has %d tags" % (name,
+                                               len(self._vocabs[name][1])))
+        return self._vocabs[name]
+
+    def _valid(self, tag_name):
+        try:
+            tag_length_validator(tag_name, self.context)
+            tag_name_validator(tag_name, self.context)
+        except Invalid, e:
+            log.warn('Skipping tag "%s": %s' % (tag_name, e.error))
+            return False
+        return True
+
+    def load(self, rows):
+        """
+        Inserts the missing tags of an iterable of ``(vocabulary name, tag
+        name)`` pairs.
+        """
+        self._started = time.time()
+        for vocab_name, tag_name in rows:
+            self.rows += 1
+            vocab_id, tag_names = self._vocabulary(vocab_name)
+            if tag_name in tag_names:
+                continue
+            if not self._valid(tag_name):
+                self.rejected += 1
+                continue
+            model.Session.add(model.Tag(name=tag_name, vocabulary_id=vocab_id))
+            tag_names.add(tag_name)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._commit()
+        self._commit()
+        cache.invalidate_vocabularies()
+        tag_index.drop()
+
+    def _commit(self):
+        if self._pending:
+            model.Session.commit()
+            self.inserted += self._pending
+            self._pending = 0
+        elapsed = time.time() - self._started
+        log.info("%d rows read, %d tags inserted, %d rejected "
+                 "(%.0f rows/s)" % (self.rows, self.inserted, self.rejected,
+                                    self.rows / max(elapsed, 0.001)))
@@ -0,0 +1,256 @@
+"""
+In-process load test of the pages the example plugins change, used by
+``paster example load-test``.
+
+The CKAN WSGI application is built from the config file, with the
+extension's plugins loaded, and pointed at a database seeded with
+synthetic vocabularies and datasets (see ``standin.py``).  A number of
+virtual users, each in its own thread, then request these pages in turn
+for a fixed duration, calling the application directly rather than going
+through a web server:
+
+* the home page, filtered by the ``examplething`` stream rule
+* a dataset page, with the vocabulary tags in its sidebar
+* a dataset's edit form (the ``package_formalchemy`` controller)
+* the registration and user edit forms of ``CustomUserController``
+
+The pages needing a logged in user are requested as a sysadmin created
+for the test.  The results hold the throughput and the p50/p95/p99
+latencies and latency histogram of each page, and can be compared with
+the results of an earlier run to catch regressions.
+"""
+import sys
+import time
+import random
+import bisect
+import logging
+import threading
+
+from webob import Request
+
+from ckan import model
+
+from metrics import BUCKETS
+
+log = logging.getLogger(__name__)
+
+USER = u'example-load-test'
+
+# (name, path, whether it needs a logged in user) of each page requested.
+# ``{dataset}`` is replaced by the name of a random seeded dataset.
+SCENARIOS = [
+    ('home', '/', False),
+    ('package_read', '/package/{dataset}', False),
+    ('package_edit', '/package/edit/{dataset}', True),
+    ('user_register', '/user/register', False),
+    ('user_edit', '/user/edit', True),
+]
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def create_user(name=USER):
+    """
+    Adds the sysadmin the virtual users log in as, unless it exists.
+    """
+    user = model.User.by_name(name)
+    if user is None:
+        user = model.User(name=name, fullname=u'Load test user',
+                          email=u'load-test@example.com',
+                          password=u'load-test')
+        model.Session.add(user)
+        model.Session.flush()
+        model.add_user_to_role(user, model.Role.ADMIN, model.System())
+        model.repo.commit_and_remove()
+    return name
+
+
+def percentile(samples, q):
+    """
+    Returns the ``q`` quantile of a sorted list of samples.
+    """
+    if not samples:
+        return None
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class LoadTest(object):
+    """Requests the ``scenarios`` pages of ``app`` from ``users`` threads
+    for ``duration`` seconds.
+    """
+
+    def __init__(self, app, datasets, user=USER, users=8, duration=30,
+                 scenarios=SCENARIOS, random_seed=0):
+        self.app = app
+        self.datasets = datasets
+        self.user = user
+        self.users = users
+        self.duration = duration
+        self.scenarios = scenarios
+        self.random_seed = random_seed
+        # scenario name -> list of latencies in seconds, and error count
+        self._latencies = dict((name, []) for name, path, login in scenarios)
+        self._errors = dict((name, 0) for name, path, login in scenarios)
+        self._lock = threading.Lock()
+
+    def request(self, path, login=False):
+        """
+        Calls the application for ``path``, reading the whole response,
+        and returns its status code and how long it took.
+        """
+        environ = Request.blank(path).environ
+        if login:
+            environ['REMOTE_USER'] = self.user.encode('utf-8')
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+            return lambda data: None
+
+        start = time.time()
+        result = self.app(environ, start_response)
+        try:
+            for chunk in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return status[0], time.time() - start
+
+    def _path(self, path, rand):
+        return path.replace('{dataset}', rand.choice(self.datasets))
+
+    def _virtual_user(self, number, deadline):
+        rand = random.Random(self.random_seed + number)
+        # Start each user on a different page, so they don't all hit the
+        # same one at the same time.
+        step = number
+        while time.time() < deadline:
+            name, path, login = self.scenarios[step % len(self.scenarios)]
+            step += 1
+            try:
+                status, seconds = self.request(self._path(path, rand), login)
+            except Exception, e:
+                log.warn('Requesting %s failed: %s' % (path, e))
+                status = None
+            with self._lock:
+                if status is None or status >= 400:
+                    self._errors[name] += 1
+                else:
+                    self._latencies[name].append(seconds)
+
+    def warm_up(self):
+        """
+        Requests each page once, so that templates are loaded and caches
+        filled before the timed run.  Raises an exception if one of them
+        doesn't answer with a success or redirect.
+        """
+        rand = random.Random(self.random_seed)
+        for name, path, login in self.scenarios:
+            status, seconds = self.request(self._path(path, rand), login)
+            if status >= 400:
+                raise Exception('%s (%s) answered %d' % (name, path, status))
+            log.info('Warmed up %s in %.0f ms' % (name, seconds * 1000))
+
+    def run(self):
+        """
+        Runs the virtual users, and returns the results.
+        """
+        self.warm_up()
+        started = time.time()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self._virtual_user,
+                                    args=(number, deadline),
+                                    name='ckanext-example-load-test-%d'
+                                         % number)
+                   for number in range(self.users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        scenarios = {}
+        total = 0
+        for name, path, login in self.scenarios:
+            latencies = sorted(self._latencies[name])
+            total += len(latencies)
+            buckets = [0] * (len(BUCKETS) + 1)
+            for seconds in latencies:
+                buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+            scenarios[name] = {
+                'path': path,
+                'requests': len(latencies),
+                'errors': self._errors[name],
+                'throughput': len(latencies) / elapsed,
+                'latency_ms': dict(
+                    ('p%d' % round(q * 100), percentile(latencies, q) * 1000
+                     if latencies else None)
+                    for q in QUANTILES),
+                'histogram': zip([bound * 1000 for bound in BUCKETS] +
+                                 ['+Inf'], buckets),
+            }
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'parameters': {'users': self.users, 'duration': self.duration,
+                           'datasets': len(self.datasets)},
+            'elapsed': elapsed,
+            'throughput': total / elapsed,
+            'scenarios': scenarios,
+        }
+
+
+def compare(results, baseline, max_latency=20, max_throughput=20,
+            max_errors=0):
+    """
+    Returns a description of each regression of ``results`` compared with
+    the ``baseline`` results: a latency percentile of a page more than
+    ``max_latency`` percent higher, a throughput more than
+    ``max_throughput`` percent lower, or more than ``max_errors`` failed
+    requests.
+    """
+    regressions = []
+
+    def check_throughput(label, current, previous):
+        if previous and current < previous * (1 - max_throughput / 100.0):
+            regressions.append('%s throughput fell from %.1f to %.1f '
+                               'requests/s' % (label, previous, current))
+
+    check_throughput('Overall', results['throughput'],
+                     baseline.get('throughput'))
+    for name, current in sorted(results['scenarios'].iteritems()):
+        if current['errors'] > max_errors:
+            regressions.append('%s had %d failed requests'
+                               % (name, current['errors']))
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        check_throughput(name, current['throughput'],
+                         previous.get('throughput'))
+        for key in sorted(current['latency_ms']):
+            now = current['latency_ms'][key]
+            before = previous.get('latency_ms', {}).get(key)
+            if now is not None and before and \
+                    now > before * (1 + max_latency / 100.0):
+                regressions.append('%s %s latency rose from %.1f to %.1f ms'
+                                   % (name, key, before, now))
+    return regressions
+
+
+def summary(results):
+    """
+    Returns a table of the throughput and latencies of each page.
+    """
+    lines = ['%-14s %8s %7s %8s %8s %8s %8s' % (
+        'page', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for name, result in sorted(results['scenarios'].iteritems()):
+        latency = result['latency_ms']
+        lines.append('%-14s %8d %7d %8.1f %8s %8s %8s' % ((
+            name, result['requests'], result['errors'],
+            result['throughput']) + tuple(
+                '-' if latency[key] is None else '%.1f' % latency[key]
+                for key in ('p50', 'p95', 'p99'))))
+    lines.append('%-14s %8s %7s %8.1f' % ('total', '', '',
+                                          results['throughput']))
+    return '\n'.join(lines)
@@ -0,0 +1,207 @@
+"""
+Latency instrumentation of the example plugins' hooks.
+
+Hooks decorated with ``timed`` (or wrapped in a ``timer`` block) record
+how long each call took in a per-process histogram, labelled by hook and
+by the route of the request.  ``render()`` formats the histograms and the
+cache counters in the Prometheus text format, which is served by
+``ExampleController.metrics``.
+
+Instrumentation is off unless ``ckanext.example.metrics`` is true.  When
+it is off, and the profiler (see ``profiler.py``) is not enabled either,
+the hooks only pay for a check of two module globals.
+"""
+import bisect
+import time
+import functools
+import threading
+
+from paste.deploy.converters import asbool
+from pylons import request
+
+import cache
+import profiler
+
+enabled = False
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5)
+
+# Number of recent samples each histogram keeps to compute percentiles
+SAMPLES = 1024
+
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+class Histogram(object):
+    """Counts observations in fixed buckets, and keeps the most recent
+    ones to compute percentiles from.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._samples = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+            self.count += 1
+            self.sum += value
+            if len(self._samples) < SAMPLES:
+                self._samples.append(value)
+            else:
+                self._samples[self._next] = value
+                self._next = (self._next + 1) % SAMPLES
+
+    def percentiles(self):
+        """
+        Returns the ``QUANTILES`` of the recent samples.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return []
+        return [(q, samples[min(int(q * len(samples)), len(samples) - 1)])
+                for q in QUANTILES]
+
+
+# (hook, route) -> Histogram
+_histograms = {}
+_lock = threading.Lock()
+
+
+def configure(config):
+    """
+    Turns instrumentation on or off according to the config.
+    """
+    global enabled
+    enabled = asbool(config.get('ckanext.example.metrics', False))
+
+
+def _route():
+    try:
+        routes = request.environ.get('pylons.routes_dict') or {}
+    except TypeError:
+        # Not in a request, e.g. running a paster command
+        return ''
+    return '%s/%s' % (routes.get('controller', ''), routes.get('action', ''))
+
+
+def observe(hook, seconds):
+    """
+    Records that a call to ``hook`` during the current request took
+    ``seconds``.
+    """
+    key = (hook, _route())
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _lock:
+            histogram = _histograms.setdefault(key, Histogram())
+    histogram.observe(seconds)
+
+
+class timer(object):
+    """Context manager timing the block it wraps as a call to ``hook``.
+
+    The block is also sampled by the profiler if the request is profiled.
+    """
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.profiled = False
+
+    def __enter__(self):
+        if profiler.enabled:
+            self.profiled = profiler.enter()
+        if enabled:
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if enabled:
+            observe(self.hook, time.time() - self.start)
+        if self.profiled:
+            profiler.leave()
+
+
+def timer_if_enabled(hook):
+    """
+    Returns a ``timer`` for ``hook``, or None if neither instrumentation
+    nor the profiler is on, for hooks which hand their timer over to code
+    running later, like the stream filters.
+    """
+    if enabled or profiler.enabled:
+        return timer(hook)
+    return None
+
+
+def timed(hook):
+    """
+    Decorator timing each call of the decorated function as ``hook``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (enabled or profiler.enabled):
+                return func(*args, **kwargs)
+            with timer(hook):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def render():
+    """
+    Returns the hook histograms and cache counters of this process in the
+    Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP ckanext_example_hook_duration_seconds '
+        'Time spent in the example plugins\' hooks.',
+        '# TYPE ckanext_example_hook_duration_seconds histogram',
+    ]
+    quantiles = [
+        '# HELP ckanext_example_hook_duration_quantile_seconds '
+        'Percentiles of the recent calls of each hook.',
+        '# TYPE ckanext_example_hook_duration_quantile_seconds gauge',
+    ]
+    name = 'ckanext_example_hook_duration_seconds'
+    for (hook, route), histogram in sorted(_histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.buckets):
+            cumulative += count
+            lines.append('%s_bucket{%s} %d' % (
+                name, _labels(hook=hook, route=route, le=bound), cumulative))
+        labels = _labels(hook=hook, route=route)
+        lines.append('%s_sum{%s} %.9f' % (name, labels, histogram.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+        for q, value in histogram.percentiles():
+            quantiles.append('%s_quantile_seconds{%s} %.9f' % (
+                name[:-len('_seconds')],
+                _labels(hook=hook, route=route, quantile=q), value))
+    lines.extend(quantiles)
+
+    stats = cache.stats().values()
+    for metric, kind, help in [
+            ('hits', 'counter', 'Cache hits.'),
+            ('misses', 'counter', 'Cache misses.'),
+            ('size', 'gauge', 'Number of cached entries.')]:
+        suffix = '_total' if kind == 'counter' else ''
+        lines.append('# HELP ckanext_example_cache_%s%s %s'
+                     % (metric, suffix, help))
+        lines.append('# TYPE ckanext_example_cache_%s%s %s'
+                     % (metric, suffix, kind))
+        for cache_stats in sorted(stats, key=lambda s: s['name']):
+            lines.append('ckanext_example_cache_%s%s{%s} %d' % (
+                metric, suffix, _labels(cache=cache_stats['name']),
+                cache_stats[metric]))
+    return '\n'.join(lines) + '\n'
@@ -1,9 +1,16 @@
 from sqlalchemy.util import OrderedDict
-from pylons.i18n import _
+from pylons.i18n import _, get_lang
 
 from ckan.forms import common
 from ckan.forms import package
 
+import cache
+import metrics
+
+# Unbound fieldsets, by (is_admin, user editable groups, locale)
+fieldset_cache = cache.Cache('fieldset', maxsize=64)
+cache.register(fieldset_cache)
+
 
 # Setup the fieldset
 def build_example_form(is_admin=False,
@@ -33,7 +40,53 @@ def build_example_form(is_admin=False,
     return builder
 
 
+class _Group(object):
+    """The attributes of a group which the form renders, copied so that
+    cached fieldsets don't hold on to objects of an earlier session.
+    """
+    __slots__ = ['id', 'name', 'title', 'display_name']
+
+    def __init__(self, group):
+        for attr in self.__slots__:
+            setattr(self, attr, getattr(group, attr, None))
+
+    def key(self):
+        return (self.id, self.name, self.title)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+@metrics.timed('package_form.get_example_fieldset')
 def get_example_fieldset(is_admin=False, user_editable_groups=None, **kwargs):
+    """Returns the unbound example fieldset, built once per combination
+    of ``is_admin``, groups the user can edit and locale.
+
+    The ``package_formalchemy`` controller binds it to each request's
+    data, which works on a copy, so the cached fieldset is never changed.
+    """
+    if kwargs:
+        return build_example_fieldset(is_admin, user_editable_groups,
+                                      **kwargs)
+    if user_editable_groups is not None:
+        user_editable_groups = [_Group(g) for g in user_editable_groups]
+        groups_key = tuple(g.key() for g in user_editable_groups)
+    else:
+        groups_key = None
+    key = (bool(is_admin), groups_key, tuple(get_lang() or ()))
+    return fieldset_cache.get_or_create(
+        key, lambda: build_example_fieldset(is_admin, user_editable_groups))
+
+
+@metrics.timed('package_form.build_example_fieldset')
+def build_example_fieldset(is_admin=False, user_editable_groups=None,
+                           **kwargs):
     return build_example_form(is_admin=is_admin,
                               user_editable_groups=user_editable_groups,
                               **kwargs).get_fieldset()
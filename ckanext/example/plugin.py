@@ -1,28 +1,72 @@
 import os
+import tempfile
 from logging import getLogger
 
-from pylons import request
 from genshi.input import HTML
-from genshi.filters.transform import Transformer
+from paste.deploy.converters import asint
 
 from ckan.plugins import implements, SingletonPlugin
 from ckan.plugins import IConfigurer
+from ckan.plugins import IConfigurable
 from ckan.plugins import IGenshiStreamFilter
 from ckan.plugins import IRoutes
 
+import assets
+import cache
+import metrics
+import profiler
+import templates
+from transforms import StreamRules
+
 log = getLogger(__name__)
 
+# The stream transformations applied by ``ExamplePlugin.filter``, each
+# only on the routes it is registered for.
+stream_rules = StreamRules()
+
+# The controller serving the home page (see ``before_map``)
+HOME_CONTROLLER = 'ckanext.example.controller:ExampleHomeController'
+
+# Rename 'frob' to 'foobar' in the custom ``home/index.html`` template.
+# As this is static content of the template, it is done once at startup
+# (see ``update_config``).
+stream_rules.substitute([('home', 'index'), (HOME_CONTROLLER, 'index')],
+                        '//p[@id="examplething"]/text()', r'frob', r'foobar',
+                        template='home/index.html')
+
+# Add the chosen JQuery plugin to the dataset forms, fetching the
+# vocabulary tags as the user types.  Its stylesheet is part of the
+# ``css/example.css`` bundle linked from every page.
+def chosen_script():
+    return cache.get_static('chosen_script', lambda: list(HTML(
+        '''
+        <script src="%s" type="text/javascript"></script>
+        <script src="%s" type="text/javascript"></script>
+        <script type="text/javascript">
+          $(".chzn-select").chosen();
+          $(".chzn-select[data-autocomplete-url]").vocabAutocomplete();
+        </script>
+        ''' % (assets.urls('scripts/chosen.jquery.min.js')[0],
+               assets.urls('scripts/vocab-autocomplete.js')[0])
+    )))
+
+stream_rules.append([('package', 'new'), ('package', 'edit')], 'body',
+                    chosen_script)
+
 
 class ExamplePlugin(SingletonPlugin):
     """This plugin demonstrates how a theme packaged as a CKAN
     extension might extend CKAN behaviour.
 
-    In this case, we implement three extension interfaces:
+    In this case, we implement four extension interfaces:
 
       - ``IConfigurer`` allows us to override configuration normally
         found in the ``ini``-file.  Here we use it to specify the site
         title, and to tell CKAN to look in this package for templates
         and resources that customise the core look and feel.
+
+      - ``IConfigurable`` is called once CKAN is configured.  We use it
+        to look up our templates in an index rather than on disk.
         
       - ``IGenshiStreamFilter`` allows us to filter and transform the
         HTML stream just before it is rendered.  In this case we use
@@ -33,6 +77,7 @@ class ExamplePlugin(SingletonPlugin):
         ``/register`` behaviour with a custom controller
     """
     implements(IConfigurer, inherit=True)
+    implements(IConfigurable, inherit=True)
     implements(IGenshiStreamFilter, inherit=True)
     implements(IRoutes, inherit=True)
 
@@ -52,18 +97,46 @@ class ExamplePlugin(SingletonPlugin):
                                       'example', 'theme', 'public')
         template_dir = os.path.join(rootdir, 'ckanext',
                                     'example', 'theme', 'templates')
+        # apply the static stream rules to copies of our templates, which
+        # must be found before the originals
+        compiled_dir = config.get('ckanext.example.compiled_templates_dir')
+        if not compiled_dir and config.get('cache_dir'):
+            compiled_dir = os.path.join(config['cache_dir'],
+                                        'ckanext-example-templates')
+        if not compiled_dir:
+            compiled_dir = os.path.join(
+                tempfile.gettempdir(), 'ckanext-example-templates-%s-%d' % (
+                    config.get('ckan.site_id') or 'default', os.getuid()))
+        if stream_rules.precompile([template_dir], compiled_dir):
+            template_dirs = [compiled_dir, template_dir]
+        else:
+            template_dirs = [template_dir]
         # set our local template and resource overrides
         config['extra_public_paths'] = ','.join([our_public_dir,
                 config.get('extra_public_paths', '')])
-        config['extra_template_paths'] = ','.join([template_dir,
-                config.get('extra_template_paths', '')])
-        # add in the extra.css
+        templates.add_template_paths(config, *template_dirs)
+        # add in the extra.css and chosen.css bundle, fingerprinted if
+        # ``paster example build-assets`` has been run
+        assets.load_manifest()
         config['ckan.template_head_end'] = config.get('ckan.template_head_end', '') +\
-                                           '<link rel="stylesheet" href="/css/extra.css" type="text/css"> '
+            ''.join('<link rel="stylesheet" href="%s" type="text/css"> ' % url
+                    for url in assets.urls('css/example.css'))
         # set the title
         config['ckan.site_title'] = "Example CKAN theme"
         # set the customised package form (see ``setup.py`` for entry point)
         config['package_form'] = "example_form"
+        # set how long the home page is cached for
+        cache.home_page_cache.configure(
+            ttl=asint(config.get('ckanext.example.home_cache_ttl', 60)))
+        # turn the hooks' latency instrumentation on or off
+        metrics.configure(config)
+        profiler.configure(config)
+
+    def configure(self, config):
+        """Looks up our templates in an index built at startup, rather
+        than searching the template directories for them.
+        """
+        templates.install(config)
 
     def filter(self, stream):
         """Conform to IGenshiStreamFilter interface.
@@ -73,25 +146,11 @@ class ExamplePlugin(SingletonPlugin):
         part of the package).
 
         It also adds the chosen JQuery plugin to the page if viewing the
-        dataset edit page (provides a better UX for working with tags with vocabularies)
+        dataset new or edit page (provides a better UX for working with tags
+        with vocabularies, fetching them as the user types)
         """
-        stream = stream | Transformer('//p[@id="examplething"]/text()')\
-                 .substitute(r'frob', r'foobar')
-
-        routes = request.environ.get('pylons.routes_dict')
-        if routes.get('controller') == 'package' \
-            and routes.get('action') == 'edit':
-                stream = stream | Transformer('head').append(HTML(
-                    '<link rel="stylesheet" href="/css/chosen.css" />'
-                ))
-                stream = stream | Transformer('body').append(HTML(
-                    '''
-                    <script src="/scripts/chosen.jquery.min.js" type="text/javascript"></script>'
-                    <script type="text/javascript">$(".chzn-select").chosen();</script>
-                    '''
-                ))
-
-        return stream
+        return stream_rules.apply(
+            stream, metrics.timer_if_enabled('ExamplePlugin.filter'))
 
     def before_map(self, map):
         """This IRoutes implementation overrides the standard
@@ -102,6 +161,8 @@ class ExamplePlugin(SingletonPlugin):
         Note that we have also provided a custom register form
         template at ``theme/templates/user/register.html``.
         """
+        # Serve the home page to anonymous users from a cache
+        map.connect('/', controller=HOME_CONTROLLER, action='index')
         # Hook in our custom user controller at the points of creation
         # and edition.
         map.connect('/user/register',
@@ -114,6 +175,19 @@ class ExamplePlugin(SingletonPlugin):
                     controller='ckanext.example.controller:CustomUserController',
                     action='edit')
 
+        map.connect('/example/cache-stats',
+                    controller='ckanext.example.controller:ExampleController',
+                    action='cache_stats')
+        map.connect('/example/metrics',
+                    controller='ckanext.example.controller:ExampleController',
+                    action='metrics')
+        map.connect('/example/tags/{vocab}',
+                    controller='ckanext.example.controller:ExampleController',
+                    action='tag_autocomplete')
+        map.connect(assets.URL_PREFIX + '{filename}',
+                    controller='ckanext.example.controller:ExampleController',
+                    action='asset')
+
         map.connect('/package/new', controller='package_formalchemy', action='new')
         map.connect('/package/edit/{id}', controller='package_formalchemy', action='edit')
         return map
@@ -0,0 +1,251 @@
+"""
+On-demand sampling profiler for the example plugins' hooks.
+
+A fraction of requests (``ckanext.example.profile.rate``), and requests
+carrying a valid signed ``X-Example-Profile`` header, are profiled.  While
+such a request runs one of the hooks timed by ``metrics`` (the stream
+filters, the dataset form hooks and the custom user controller's
+actions), its thread is marked as active, and a background thread takes
+a snapshot of the active threads' stacks every
+``ckanext.example.profile.interval`` milliseconds.
+
+The samples of each profiled request are written to
+``ckanext.example.profile.dir`` in the collapsed stack format read by
+``flamegraph.pl`` and speedscope, one line per distinct stack::
+
+    module:function;module:function;... count
+
+Threads which aren't marked are never looked at, and at most
+``ckanext.example.profile.max_active`` requests per process are profiled
+at a time, so the profiler can be left on with a low rate.
+"""
+import os
+import sys
+import stat
+import time
+import hmac
+import errno
+import random
+import hashlib
+import logging
+import tempfile
+import threading
+import itertools
+
+from pylons import request
+
+log = logging.getLogger(__name__)
+
+HEADER = 'X-Example-Profile'
+
+enabled = False
+rate = 0.0
+secret = None
+interval = 0.01
+max_active = 4
+directory = None
+
+ENVIRON_KEY = 'ckanext.example.profile'
+
+# thread id -> [Profile, depth of nested hooks]
+_active = {}
+_lock = threading.Lock()
+_wake = threading.Event()
+_sampler = None
+_sequence = itertools.count()
+
+
+def configure(config):
+    """
+    Sets up the profiler from the ``ckanext.example.profile.*`` options.
+    The profiles are written to a directory of CKAN's ``cache_dir`` by
+    default, or else to a directory of the system's temporary directory
+    named after the site id and user.
+    """
+    global enabled, rate, secret, interval, max_active, directory
+    rate = float(config.get('ckanext.example.profile.rate', 0))
+    secret = config.get('ckanext.example.profile.secret') or None
+    interval = float(config.get('ckanext.example.profile.interval', 10)) / 1000
+    max_active = int(config.get('ckanext.example.profile.max_active', 4))
+    directory = config.get('ckanext.example.profile.dir')
+    if not directory and config.get('cache_dir'):
+        directory = os.path.join(config['cache_dir'],
+                                 'ckanext-example-profiles')
+    if not directory:
+        directory = os.path.join(
+            tempfile.gettempdir(), 'ckanext-example-profiles-%s-%d' % (
+                config.get('ckan.site_id') or 'default', os.getuid()))
+    enabled = rate > 0 or secret is not None
+
+
+def sign(expires):
+    """
+    Returns the ``X-Example-Profile`` header value requesting a profile,
+    valid until the ``expires`` timestamp.
+    """
+    expires = str(int(expires))
+    digest = hmac.new(secret, expires, hashlib.sha256).hexdigest()
+    return '%s:%s' % (expires, digest)
+
+
+def _signed(value):
+    if not secret or not value or ':' not in value:
+        return False
+    expires, digest = value.split(':', 1)
+    try:
+        if int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    expected = sign(expires).split(':', 1)[1]
+    # Compare in constant time, so the digest can't be guessed byte by byte
+    if len(digest) != len(expected):
+        return False
+    return reduce(lambda a, b: a | b,
+                  [ord(x) ^ ord(y) for x, y in zip(digest, expected)]) == 0
+
+
+class Profile(object):
+    """The stack samples of one request.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.time()
+        self.samples = 0
+        self.counts = {}
+        self.path = os.path.join(directory, '%s-%d-%d-%s.collapsed' % (
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime(self.started)),
+            os.getpid(), _sequence.next(), route.replace('/', '.')))
+
+    def add(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (frame.f_globals.get('__name__', '?'),
+                                    code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        key = ';'.join(stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def save(self):
+        """
+        (Re)writes the samples collected so far.
+        """
+        if not self.samples:
+            return
+        _check_directory()
+        with open(self.path, 'w') as f:
+            for stack, count in sorted(self.counts.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+
+
+def _check_directory():
+    """
+    Creates the profile directory, readable by its owner only, unless it
+    exists.  Raises OSError if it is not a directory of the current user
+    which only that user can write to, as the profiles show the code run
+    by the requests.
+    """
+    try:
+        os.makedirs(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(errno.EPERM, 'Not a directory private to this user',
+                      directory)
+
+
+def _request_profile():
+    """
+    Returns the Profile of the current request, deciding the first time
+    it is called whether the request is profiled at all.
+    """
+    try:
+        environ = request.environ
+    except TypeError:
+        # Not in a request, e.g. running a paster command
+        return None
+    if ENVIRON_KEY not in environ:
+        profile = None
+        if _signed(environ.get('HTTP_X_EXAMPLE_PROFILE')) or \
+                random.random() < rate:
+            routes = environ.get('pylons.routes_dict') or {}
+            profile = Profile('%s/%s' % (routes.get('controller', ''),
+                                         routes.get('action', '')))
+        environ[ENVIRON_KEY] = profile
+    return environ[ENVIRON_KEY]
+
+
+def enter():
+    """
+    Marks the current thread as running a profiled hook, if the current
+    request is profiled.  Returns whether it is, in which case ``leave()``
+    must be called once the hook returns.
+    """
+    profile = _request_profile()
+    if profile is None:
+        return False
+    ident = threading.current_thread().ident
+    with _lock:
+        entry = _active.get(ident)
+        if entry is not None:
+            entry[1] += 1
+            return True
+        if len(_active) >= max_active:
+            return False
+        _active[ident] = [profile, 1]
+        _start_sampler()
+    _wake.set()
+    return True
+
+
+def leave():
+    """
+    Unmarks the current thread once its outermost profiled hook returns,
+    and writes the request's samples so far.
+    """
+    ident = threading.current_thread().ident
+    with _lock:
+        entry = _active[ident]
+        entry[1] -= 1
+        if entry[1]:
+            return
+        del _active[ident]
+        if not _active:
+            _wake.clear()
+    try:
+        entry[0].save()
+    except (IOError, OSError), e:
+        log.warn('Could not write profile %s: %s' % (entry[0].path, e))
+
+
+def _sample():
+    while True:
+        _wake.wait()
+        time.sleep(interval)
+        # Holding the lock while sampling means a profile is never added
+        # to once its thread has left the hook and is writing it out.
+        with _lock:
+            if not _active:
+                continue
+            frames = sys._current_frames()
+            for ident, (profile, depth) in _active.iteritems():
+                frame = frames.get(ident)
+                if frame is not None:
+                    profile.add(frame)
+            del frames, frame
+
+
+def _start_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = threading.Thread(target=_sample,
+                                    name='ckanext-example-profiler')
+        _sampler.daemon = True
+        _sampler.start()
@@ -0,0 +1,102 @@
+"""
+Per-process caching of the form schemas returned by our plugins.
+
+CKAN asks the form plugins for their schemas on every form submission
+and every dataset read, and building them means calling the core schema
+functions and creating fresh validator lists each time.  As the result
+is always the same, ``cached_schema`` builds it once and hands out a
+frozen copy: ``FrozenDict`` and ``FrozenList`` instead of dicts and
+lists, so a caller cannot modify the schema shared by every request.
+They are still dicts and lists, which is what the navl validation
+functions look for.  A caller that
+needs to modify it can take a mutable deep copy with ``.copy()``.
+"""
+import functools
+
+
+class FrozenDict(dict):
+    """A dict that cannot be modified in place.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Cached schemas are shared and cannot be modified, '
+                        'use .copy() to get a mutable copy')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def copy(self):
+        """
+        Returns a mutable deep copy, with dicts and lists in place of the
+        frozen ones.
+        """
+        return thaw(self)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """A list of validators that cannot be modified in place.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('Cached schemas are shared and cannot be modified, '
+                        'use .copy() to get a mutable copy')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _immutable
+    __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def copy(self):
+        """
+        Returns a mutable copy.
+        """
+        return thaw(self)
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze(schema):
+    """
+    Returns a frozen copy of a schema: dicts become ``FrozenDict`` and
+    lists of validators ``FrozenList``.
+    """
+    if isinstance(schema, dict):
+        return FrozenDict((key, freeze(value))
+                          for key, value in schema.iteritems())
+    if isinstance(schema, list):
+        return FrozenList(schema)
+    return schema
+
+
+def thaw(schema):
+    """
+    Returns a mutable copy of a schema frozen by ``freeze()``.
+    """
+    if isinstance(schema, dict):
+        return dict((key, thaw(value)) for key, value in schema.iteritems())
+    if isinstance(schema, list):
+        return list(schema)
+    return schema
+
+
+_schemas = {}
+
+
+def cached_schema(build):
+    """
+    Decorator for plugin methods returning a schema, so that the schema is
+    built once per process and returned frozen.  The undecorated method is
+    kept as the ``uncached`` attribute.
+    """
+    @functools.wraps(build)
+    def wrapper(self):
+        key = (self.__class__, build.__name__)
+        schema = _schemas.get(key)
+        if schema is None:
+            schema = _schemas[key] = freeze(build(self))
+        return schema
+    wrapper.uncached = build
+    return wrapper
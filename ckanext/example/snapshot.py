@@ -0,0 +1,306 @@
+"""
+A snapshot of the vocabularies, their tags and the license options,
+shared by every CKAN process on the host.
+
+Each pre-forked worker used to load this data from the database into its
+own caches, and to notice changes made by other processes only once its
+cache entries expired.  Instead, one process writes the data to a SQLite
+file, which every process reads through the operating system's page
+cache, and a generation counter kept in a file next to it is bumped
+whenever a vocabulary or tag changes (by the wrapped actions in
+``actions.py`` and by the ``paster example`` commands).
+
+A process seeing a new generation drops its cached vocabularies (see
+``cache.sync``), and the first one to notice that the snapshot is older
+than the current generation rebuilds it in a background thread.  Until
+the rebuilt snapshot is in place, lookups fall back to the database.
+
+As the snapshot feeds tag validation, its directory is private to the
+CKAN instance: it is created readable by its owner only, and a directory
+which belongs to another user, or which other users can write to, is
+never read nor written.
+"""
+import os
+import json
+import time
+import stat
+import errno
+import fcntl
+import sqlite3
+import logging
+import tempfile
+import threading
+
+from ckan import model
+
+log = logging.getLogger(__name__)
+
+# Minimum number of seconds between two attempts of a process to rebuild
+# the snapshot, e.g. while another process is building it.
+REBUILD_INTERVAL = 5
+
+
+class SnapshotUnavailable(Exception):
+    """Raised when the snapshot is missing or older than the current
+    generation, so that the caller reads the database instead.
+    """
+    pass
+
+
+def _locked(path, blocking=True):
+    """
+    Returns an open file holding an exclusive lock on ``path``, or None if
+    ``blocking`` is False and the lock is held by another process.
+    """
+    lock = open(path, 'a')
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(lock, flags)
+    except IOError:
+        lock.close()
+        return None
+    return lock
+
+
+class SnapshotStore(object):
+    """The snapshot file and generation counter in ``directory``.
+    """
+
+    def __init__(self, directory=None):
+        self._rebuilding = threading.Lock()
+        self._attempted = 0
+        self._refused = None
+        self.configure({})
+        if directory is not None:
+            self._set_directory(directory)
+
+    def _set_directory(self, directory):
+        # Connections to the snapshot of another directory are not reused
+        self._local = threading.local()
+        self.directory = directory
+        self.path = os.path.join(directory, 'snapshot.db')
+        self.generation_path = os.path.join(directory, 'generation')
+        self.lock_path = os.path.join(directory, 'lock')
+
+    def configure(self, config):
+        """
+        Applies the ``ckanext.example.snapshot_dir`` option, which defaults
+        to a directory of CKAN's ``cache_dir``, or else to a directory of
+        the system's temporary directory named after the site id and user.
+        """
+        directory = config.get('ckanext.example.snapshot_dir')
+        if not directory and config.get('cache_dir'):
+            directory = os.path.join(config['cache_dir'], 'ckanext-example')
+        if not directory:
+            directory = os.path.join(
+                tempfile.gettempdir(), 'ckanext-example-%s-%d' % (
+                    config.get('ckan.site_id') or 'default', os.getuid()))
+        self._set_directory(directory)
+
+    def _check_directory(self, create=False):
+        """
+        Raises OSError unless the directory (created with mode 0700 if
+        ``create`` is True) belongs to the current user and can't be
+        written to by others.
+        """
+        if create:
+            try:
+                os.makedirs(self.directory, 0700)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        info = os.lstat(self.directory)
+        if not stat.S_ISDIR(info.st_mode) or \
+                info.st_uid != os.getuid() or \
+                info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            if self._refused != self.directory:
+                self._refused = self.directory
+                log.error('Not using the vocabulary snapshot directory %s, '
+                          'which is not a directory owned by this user and '
+                          'writable by it only' % self.directory)
+            raise OSError(errno.EPERM, 'Unsafe snapshot directory',
+                          self.directory)
+
+    def generation(self):
+        """
+        Returns the current generation, 0 if it has never been bumped.
+        """
+        try:
+            with open(self.generation_path) as f:
+                return int(f.read() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def bump(self):
+        """
+        Increments the generation, invalidating the snapshot and the
+        cached vocabularies of every process.
+        """
+        self._check_directory(create=True)
+        lock = _locked(self.lock_path)
+        try:
+            generation = self.generation() + 1
+            tmp = '%s.%d' % (self.generation_path, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(str(generation))
+            os.rename(tmp, self.generation_path)
+        finally:
+            lock.close()
+        log.debug('Vocabulary snapshot generation is now %d' % generation)
+        return generation
+
+    def _connection(self, rebuild=True):
+        """
+        Returns this thread's connection to the snapshot, if it is up to
+        date.  Otherwise starts rebuilding it, unless ``rebuild`` is False.
+        """
+        generation = self.generation()
+        local = self._local
+        if getattr(local, 'connection', None) is None or \
+                local.generation != generation or \
+                local.pid != os.getpid():
+            if getattr(local, 'connection', None) is not None and \
+                    local.pid == os.getpid():
+                local.connection.close()
+            local.connection = None
+            try:
+                self._check_directory()
+                exists = os.path.exists(self.path)
+            except OSError:
+                exists = False
+            if exists:
+                connection = sqlite3.connect(self.path)
+                stamp = connection.execute(
+                    'SELECT value FROM meta WHERE key = ?',
+                    ('generation',)).fetchone()
+                if stamp and int(stamp[0]) == generation:
+                    local.connection = connection
+                else:
+                    connection.close()
+            local.generation = generation
+            local.pid = os.getpid()
+        if local.connection is None:
+            if rebuild:
+                self.rebuild_in_background()
+            raise SnapshotUnavailable()
+        return local.connection
+
+    def vocabulary(self, name):
+        """
+        Returns a dict with the ``id`` and ``name`` of the named
+        vocabulary, or None if it doesn't exist.
+        """
+        row = self._connection().execute(
+            'SELECT id, name FROM vocabulary WHERE name = ?',
+            (name,)).fetchone()
+        return row and {'id': row[0], 'name': row[1]}
+
+    def tags(self, name):
+        """
+        Returns a list of the ``(name, id)`` pairs of the tags of the named
+        vocabulary, sorted by name, or None if it doesn't exist.
+        """
+        connection = self._connection()
+        if self.vocabulary(name) is None:
+            return None
+        return connection.execute(
+            'SELECT tag.name, tag.id FROM tag JOIN vocabulary '
+            'ON tag.vocabulary_id = vocabulary.id '
+            'WHERE vocabulary.name = ? ORDER BY tag.name',
+            (name,)).fetchall()
+
+    def static(self, key):
+        """
+        Returns the value stored under ``key``, such as ``licences``.
+        """
+        row = self._connection().execute(
+            'SELECT value FROM static WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise SnapshotUnavailable()
+        return json.loads(row[0])
+
+    def build(self):
+        """
+        Writes a new snapshot from the database, unless another process is
+        already doing so.  Returns whether a snapshot was written.
+        """
+        self._check_directory(create=True)
+        lock = _locked(self.lock_path + '.build', blocking=False)
+        if lock is None:
+            return False
+        try:
+            generation = self.generation()
+            tmp = '%s.%d' % (self.path, os.getpid())
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            connection = sqlite3.connect(tmp)
+            connection.executescript('''
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE vocabulary (id TEXT PRIMARY KEY,
+                                         name TEXT UNIQUE);
+                CREATE TABLE tag (id TEXT PRIMARY KEY, name TEXT,
+                                  vocabulary_id TEXT);
+                CREATE INDEX tag_vocabulary_name ON tag (vocabulary_id, name);
+                CREATE TABLE static (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+            try:
+                connection.executemany(
+                    'INSERT INTO vocabulary VALUES (?, ?)',
+                    model.Session.query(model.Vocabulary.id,
+                                        model.Vocabulary.name))
+                connection.executemany(
+                    'INSERT INTO tag VALUES (?, ?, ?)',
+                    model.Session.query(model.Tag.id, model.Tag.name,
+                                        model.Tag.vocabulary_id)
+                        .filter(model.Tag.vocabulary_id != None))
+                connection.execute(
+                    'INSERT INTO static VALUES (?, ?)',
+                    ('licences', json.dumps(
+                        model.Package.get_license_options())))
+            finally:
+                model.Session.remove()
+            connection.execute('INSERT INTO meta VALUES (?, ?)',
+                               ('generation', str(generation)))
+            connection.commit()
+            connection.close()
+            os.rename(tmp, self.path)
+        finally:
+            lock.close()
+        log.info('Wrote the vocabulary snapshot of generation %d'
+                 % generation)
+        return True
+
+    def ensure(self):
+        """
+        Builds the snapshot if it is missing or out of date.
+        """
+        try:
+            self._connection(rebuild=False)
+        except SnapshotUnavailable:
+            self.build()
+
+    def rebuild_in_background(self):
+        """
+        Rebuilds the snapshot in a thread of this process, unless one is
+        already running or was started in the last few seconds.
+        """
+        if time.time() - self._attempted < REBUILD_INTERVAL or \
+                not self._rebuilding.acquire(False):
+            return
+        self._attempted = time.time()
+
+        def _rebuild():
+            try:
+                self.build()
+            except Exception, e:
+                log.warn('Could not build the vocabulary snapshot: %s' % e)
+            finally:
+                self._rebuilding.release()
+
+        thread = threading.Thread(target=_rebuild,
+                                  name='ckanext-example-snapshot')
+        thread.daemon = True
+        thread.start()
+
+
+store = SnapshotStore()
@@ -0,0 +1,167 @@
+"""
+A local SQLite stand-in for the CKAN database, used by the benchmarks and
+the load test.
+
+``create()`` points the CKAN model at a new SQLite file (or at a scratch
+database given by its URL), so benchmarks never touch the configured
+database, and ``seed()`` fills it with
+synthetic vocabularies, tags and datasets of a configurable size.
+
+The vocabulary snapshot shared by the CKAN processes of the host (see
+``snapshot.py``) is moved to a private temporary directory meanwhile, and
+the caches aren't warmed in the background, so that no stand-in data is
+written to the real snapshot, and no real data read from it, until
+``restore()`` is called.  Datasets aren't indexed meanwhile either, so
+that the stand-in datasets never reach the configured search index (nor
+fail to be written when it can't be reached).
+"""
+import os
+import random
+import shutil
+import tempfile
+import logging
+
+import sqlalchemy
+from pylons import config
+
+from ckan import model
+from ckan import plugins
+
+import cache
+import snapshot
+
+log = logging.getLogger(__name__)
+
+# The snapshot directory and cache warming function replaced by
+# ``isolate()``, and the private snapshot directory
+_saved = None
+_directory = None
+
+# The ``ckan.search.automatic_indexing`` option replaced by ``isolate()``,
+# and whether it unloaded the plugin indexing the datasets
+INDEXING_OPTION = 'ckan.search.automatic_indexing'
+SEARCH_PLUGIN = 'synchronous_search'
+_indexing = None
+_unloaded = False
+
+
+def _no_warming(loaders):
+    log.debug('Not warming the caches of the stand-in database')
+
+
+def isolate():
+    """
+    Points the vocabulary snapshot at a private temporary directory, turns
+    off cache warming and search indexing and drops the cached
+    vocabularies.  May be called again, e.g. after loading the CKAN config
+    has configured the snapshot and loaded the plugins.
+    """
+    global _saved, _directory, _indexing, _unloaded
+    if _saved is None:
+        _saved = (snapshot.store.directory, cache.warm_in_background)
+        _directory = tempfile.mkdtemp(prefix='ckanext-example-standin-')
+        cache.warm_in_background = _no_warming
+    snapshot.store._set_directory(_directory)
+    cache._generation = None
+    cache._clear_vocabularies()
+    # The option is set to False rather than 'false', so that the value
+    # of a config loaded since the last call is told apart.
+    if config.get(INDEXING_OPTION) is not False:
+        _indexing = (config.get(INDEXING_OPTION),)
+    config[INDEXING_OPTION] = False
+    if not _unloaded:
+        try:
+            plugins.unload(SEARCH_PLUGIN)
+            _unloaded = True
+        except Exception:
+            # Not loaded, or not yet: loading the config loads it
+            pass
+
+
+def restore():
+    """
+    Points the vocabulary snapshot back at its directory, turns cache
+    warming and search indexing back on and drops the cached stand-in
+    vocabularies.
+    """
+    global _saved, _directory, _indexing, _unloaded
+    if _saved is None:
+        return
+    directory, cache.warm_in_background = _saved
+    snapshot.store._set_directory(directory)
+    cache._generation = None
+    cache._clear_vocabularies()
+    shutil.rmtree(_directory, ignore_errors=True)
+    if _indexing[0] is None:
+        config.pop(INDEXING_OPTION, None)
+    else:
+        config[INDEXING_OPTION] = _indexing[0]
+    if _unloaded:
+        plugins.load(SEARCH_PLUGIN)
+    _saved = _directory = _indexing = None
+    _unloaded = False
+
+
+def create(path=None, url=None):
+    """
+    Creates the CKAN tables in a new SQLite database (in a temporary file
+    unless ``path`` is given), or in the empty database at ``url``, and
+    binds the model to it, isolating the snapshot and caches (see
+    ``isolate()``).  Returns the path or URL of the database.
+    """
+    isolate()
+    if url is None:
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='ckanext-example-bench-',
+                                        suffix='.db')
+            os.close(fd)
+        url = 'sqlite:///%s' % path
+    engine = sqlalchemy.create_engine(url)
+    model.init_model(engine)
+    model.repo.create_db()
+    return path or url
+
+
+def seed(datasets=100, tags=1000, tags_per_dataset=10, random_seed=0):
+    """
+    Adds the example vocabularies with ``tags`` tags each, and ``datasets``
+    datasets of the ``example_dataset_form`` type, each with a
+    ``published_by`` extra and ``tags_per_dataset`` tags of each vocabulary.
+
+    Returns the names of the datasets.
+    """
+    from forms import GENRE_VOCAB, COMPOSER_VOCAB
+    rand = random.Random(random_seed)
+    vocab_tags = {}
+    for vocab_name in (GENRE_VOCAB, COMPOSER_VOCAB):
+        vocab = model.Vocabulary(vocab_name)
+        model.Session.add(vocab)
+        model.Session.flush()
+        vocab_tags[vocab_name] = [
+            model.Tag(name=u'%s %05d' % (vocab_name.split('_')[0], i),
+                      vocabulary_id=vocab.id)
+            for i in range(tags)]
+        model.Session.add_all(vocab_tags[vocab_name])
+    model.Session.commit()
+    log.info("Seeded %d tags in each vocab" % tags)
+
+    names = []
+    model.repo.new_revision()
+    for i in range(datasets):
+        pkg = model.Package(name=u'bench-dataset-%06d' % i,
+                            title=u'Benchmark dataset %d' % i,
+                            notes=u'A synthetic dataset for benchmarks.',
+                            type=u'example_dataset_form')
+        model.Session.add(pkg)
+        pkg.extras[u'published_by'] = u'Publisher %d' % (i % 10)
+        for vocab_name in (GENRE_VOCAB, COMPOSER_VOCAB):
+            k = min(tags_per_dataset, tags)
+            for tag in rand.sample(vocab_tags[vocab_name], k):
+                model.Session.add(model.PackageTag(package=pkg, tag=tag))
+        names.append(pkg.name)
+        if i % 500 == 499:
+            model.repo.commit()
+            model.repo.new_revision()
+    model.repo.commit_and_remove()
+    log.info("Seeded %d datasets" % datasets)
+    return names
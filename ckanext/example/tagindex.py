@@ -0,0 +1,111 @@
+"""
+An in-memory index of the tags of each vocabulary.
+
+CKAN's ``convert_to_tags`` and ``convert_from_tags`` converters look the
+vocabulary up on every validation, and check each submitted tag with its
+own query.  Our converters (see ``converters.py``) resolve a whole list of
+tags against this index instead, which maps each vocabulary name to its
+id and a ``{tag name: tag id}`` dict, loaded with one query per
+vocabulary.  The wrapped tag and vocabulary actions (see ``actions.py``)
+keep it up to date as tags are created and deleted.
+"""
+import threading
+
+from ckan import model
+
+import cache
+import snapshot
+from snapshot import SnapshotUnavailable
+
+
+class TagIndex(object):
+    """Maps vocabulary names to their id and ``{tag name: tag id}``.
+
+    Entries are kept in a ``cache.Cache``, so that they are dropped with
+    the other vocabulary caches when another process changes a
+    vocabulary, and loaded from the shared snapshot when it is up to date.
+    """
+
+    def __init__(self):
+        self._vocabs = cache.Cache('tag_index', maxsize=64, ttl=300)
+        self._lock = threading.Lock()
+        cache.register(self._vocabs, vocabulary=True, updated_in_place=True)
+
+    def _load(self, name):
+        try:
+            vocab = snapshot.store.vocabulary(name)
+            if vocab is None:
+                return None
+            return vocab['id'], dict(snapshot.store.tags(name))
+        except SnapshotUnavailable:
+            pass
+        vocab = model.Vocabulary.get(name)
+        if vocab is None:
+            return None
+        query = model.Session.query(model.Tag.name, model.Tag.id)\
+            .filter(model.Tag.vocabulary_id == vocab.id)
+        return vocab.id, dict(query)
+
+    def vocabulary(self, name):
+        """
+        Returns the ``(id, {tag name: tag id})`` pair of the named
+        vocabulary, or None if it does not exist.
+        """
+        cache.sync()
+        return self._vocabs.get_or_create(name, lambda: self._load(name))
+
+    def vocabulary_ids(self):
+        """
+        Returns the ids of the vocabularies currently in the index.
+        """
+        return set(entry[0] for entry in self._vocabs.values() if entry)
+
+    def resolve(self, name, tag_names):
+        """
+        Returns the id of the named vocabulary and the list of the given
+        tag names which don't belong to it, or None if the vocabulary does
+        not exist.
+        """
+        vocab = self.vocabulary(name)
+        if vocab is None:
+            return None
+        vocab_id, tags = vocab
+        return vocab_id, [t for t in tag_names if t not in tags]
+
+    def _find(self, vocabulary_id):
+        for name, entry in self._vocabs.items():
+            if entry and vocabulary_id in (entry[0], name):
+                return entry
+
+    def add_tag(self, vocabulary_id, tag_name, tag_id):
+        """
+        Adds a newly created tag to its vocabulary, if the vocabulary is
+        in the index.
+        """
+        with self._lock:
+            entry = self._find(vocabulary_id)
+            if entry:
+                entry[1][tag_name] = tag_id
+
+    def remove_tag(self, vocabulary_id, tag_name):
+        """
+        Removes a deleted tag from its vocabulary, if the vocabulary is in
+        the index.
+        """
+        with self._lock:
+            entry = self._find(vocabulary_id)
+            if entry:
+                entry[1].pop(tag_name, None)
+
+    def drop(self, name=None):
+        """
+        Drops the named vocabulary, or every vocabulary, from the index, to
+        be reloaded when next used.
+        """
+        if name is None:
+            self._vocabs.clear()
+        else:
+            self._vocabs.invalidate(name)
+
+
+tag_index = TagIndex()
@@ -0,0 +1,178 @@
+"""
+The template search path of the example plugins.
+
+Each plugin adds the theme's template directories to CKAN's
+``extra_template_paths`` with ``add_template_paths``, which leaves out the
+directories (and empty entries) already there, so that the Genshi loader
+doesn't look in the same directory several times when all the plugins are
+enabled.
+
+Once CKAN has created its template loader, ``install`` replaces those
+directories in its search path with an index of the templates they hold,
+built at startup.  Finding one of our templates is then a dictionary
+lookup, and any other name is passed on to CKAN's own directories without
+touching the filesystem.  In development (``debug = true``) the index is
+rebuilt when a file is added to or removed from one of the directories,
+and templates are reloaded when their file changes, as before.
+"""
+import os
+import time
+import errno
+import logging
+import threading
+
+from paste.deploy.converters import asbool
+
+log = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'theme', 'templates')
+
+# Minimum number of seconds between two checks of the directories for
+# added or removed templates, in development
+CHECK_INTERVAL = 1
+
+
+def _key(path):
+    return os.path.normcase(os.path.realpath(path))
+
+
+def _uptodate():
+    return True
+
+
+class TemplateIndex(object):
+    """Maps the names of the templates in ``directories`` to their files,
+    the first directory holding a template taking precedence.
+
+    Instances are Genshi template loaders (see ``__call__``), which can be
+    put on a ``TemplateLoader``'s search path.
+    """
+
+    def __init__(self, directories=(), reload=False):
+        self.directories = list(directories)
+        self.reload = reload
+        self._files = None
+        # directory -> modification time when the index was built
+        self._mtimes = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def build(self):
+        """
+        Walks the directories, and indexes every file in them.
+        """
+        files = {}
+        mtimes = {}
+        for directory in reversed(self.directories):
+            mtimes[directory] = self._mtime(directory)
+            for dirpath, dirnames, filenames in os.walk(directory):
+                mtimes[dirpath] = self._mtime(dirpath)
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    files[os.path.relpath(path, directory)] = path
+        self._files = files
+        self._mtimes = mtimes
+        self._checked = time.time()
+        log.debug('Indexed %d templates in %s'
+                  % (len(files), ', '.join(self.directories)))
+
+    def _mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _changed(self):
+        self._checked = time.time()
+        for path, mtime in self._mtimes.iteritems():
+            if self._mtime(path) != mtime:
+                return True
+        return False
+
+    def find(self, name):
+        """
+        Returns the file of the template ``name``, or None if it isn't in
+        one of the directories.
+        """
+        if self._files is None or self.reload and \
+                time.time() - self._checked > CHECK_INTERVAL:
+            with self._lock:
+                if self._files is None or self._changed():
+                    self.build()
+        return self._files.get(name)
+
+    def __call__(self, filename):
+        """
+        Opens the template ``filename``, returning its path, name, file
+        and a function telling whether the file is unchanged, as the
+        Genshi loaders do.  Raises IOError if there is no such template.
+        """
+        filepath = self.find(filename)
+        if filepath is None:
+            raise IOError(errno.ENOENT, 'No such template', filename)
+        fileobj = open(filepath, 'rb')
+        if not self.reload:
+            return filepath, filename, fileobj, _uptodate
+        mtime = os.fstat(fileobj.fileno()).st_mtime
+
+        def _file_uptodate():
+            return os.path.getmtime(filepath) == mtime
+        return filepath, filename, fileobj, _file_uptodate
+
+
+# The index of the directories added by ``add_template_paths``
+index = TemplateIndex()
+_ours = set()
+
+
+def add_template_paths(config, *directories):
+    """
+    Puts those of ``directories`` which aren't on ``extra_template_paths``
+    yet at its front, in order, and drops its duplicate and empty entries.
+    """
+    seen = set()
+    paths = []
+    for path in config.get('extra_template_paths', '').split(','):
+        path = path.strip()
+        if path and _key(path) not in seen:
+            seen.add(_key(path))
+            paths.append(path)
+    # Directories already on the path keep their place, so that one plugin
+    # can't move a directory in front of another plugin's overrides.
+    new = []
+    for directory in directories:
+        if _key(directory) not in seen:
+            seen.add(_key(directory))
+            new.append(directory)
+    paths = new + paths
+    config['extra_template_paths'] = ','.join(paths)
+
+    _ours.update(_key(directory) for directory in directories)
+    index.directories = [path for path in paths if _key(path) in _ours]
+
+
+def install(config):
+    """
+    Replaces our directories on the search path of CKAN's template loader
+    with the template index.  Called once the loader is created, by the
+    plugins' ``IConfigurable.configure``.
+    """
+    app_globals = config.get('pylons.app_globals')
+    loader = getattr(app_globals, 'genshi_loader', None)
+    if loader is None:
+        log.warn('No template loader to install the template index in')
+        return
+    if index in loader.search_path:
+        return
+    index.reload = asbool(config.get('debug', False))
+    index.build()
+    # The index takes the place of the first of our directories, so that
+    # templates overridden by other extensions still are.
+    search_path = []
+    for path in loader.search_path:
+        if isinstance(path, basestring) and _key(path) in _ours:
+            if index not in search_path:
+                search_path.append(index)
+        else:
+            search_path.append(path)
+    loader.search_path[:] = search_path
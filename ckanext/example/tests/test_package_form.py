@@ -0,0 +1,78 @@
+"""
+Tests of the fieldsets of the ``example_form`` cached by
+``package_form.get_example_fieldset``: bound to a dataset, they must render
+as a freshly built fieldset does, and keep nothing of the datasets they
+were bound to before.
+"""
+from nose.tools import assert_equal
+
+from ckan import model
+
+from ckanext.example import package_form
+from ckanext.example.package_form import get_example_fieldset
+from ckanext.example.package_form import build_example_fieldset
+
+PACKAGES = (u'test-fieldset-one', u'test-fieldset-two')
+GROUPS = (u'test-fieldset-group-a', u'test-fieldset-group-b')
+
+
+def _render(fieldset, name):
+    return fieldset.bind(model.Package.by_name(name)).render()
+
+
+class TestCachedFieldset(object):
+
+    @classmethod
+    def setup_class(cls):
+        model.repo.new_revision()
+        for name in GROUPS:
+            model.Session.add(model.Group(name=name, title=name.upper()))
+        for name in PACKAGES:
+            model.Session.add(model.Package(
+                name=name, title=u'Title of %s' % name,
+                notes=u'Notes of %s' % name))
+        model.repo.commit_and_remove()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+
+    def setup(self):
+        package_form.fieldset_cache.clear()
+
+    def _groups(self, *names):
+        return [model.Group.by_name(name) for name in names]
+
+    def test_same_as_uncached(self):
+        for is_admin, names in ((False, GROUPS[:1]), (True, GROUPS)):
+            for name in PACKAGES:
+                cached = get_example_fieldset(
+                    is_admin, user_editable_groups=self._groups(*names))
+                fresh = build_example_fieldset(
+                    is_admin, user_editable_groups=self._groups(*names))
+                assert_equal(_render(cached, name), _render(fresh, name))
+
+    def test_one_fieldset_per_key(self):
+        one = get_example_fieldset(
+            user_editable_groups=self._groups(*GROUPS[:1]))
+        assert one is get_example_fieldset(
+            user_editable_groups=self._groups(*GROUPS[:1]))
+        assert one is not get_example_fieldset(
+            is_admin=True, user_editable_groups=self._groups(*GROUPS))
+
+    def test_no_leakage_between_requests(self):
+        first = _render(get_example_fieldset(
+            user_editable_groups=self._groups(*GROUPS[:1])), PACKAGES[0])
+        assert u'Notes of %s' % PACKAGES[0] in first
+        other = _render(get_example_fieldset(
+            is_admin=True, user_editable_groups=self._groups(*GROUPS)),
+            PACKAGES[1])
+        second = _render(get_example_fieldset(
+            user_editable_groups=self._groups(*GROUPS[:1])), PACKAGES[1])
+        for html in (other, second):
+            assert PACKAGES[0] not in html
+            assert u'Notes of %s' % PACKAGES[1] in html
+        # The group the second key's user can edit isn't offered to the
+        # first key's
+        assert GROUPS[1].upper() in other
+        assert GROUPS[1].upper() not in second
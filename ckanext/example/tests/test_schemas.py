@@ -0,0 +1,103 @@
+"""
+Tests of the form schemas cached by ``schemas.cached_schema``: they must
+be the schemas the plugins build, validate data the same way, and refuse
+to be modified in place.
+"""
+import copy
+
+from nose.tools import assert_equal, assert_raises
+
+from ckan import model
+from ckan.lib.navl.dictization_functions import validate
+from ckan.lib.dictization.model_dictize import package_dictize
+
+from ckanext.example import cache
+from ckanext.example import standin
+from ckanext.example.bench import describe_schema
+from ckanext.example.forms import ExampleDatasetForm, ExampleGroupForm
+from ckanext.example.forms import GENRE_VOCAB
+from ckanext.example.schemas import FrozenDict, FrozenList
+
+PACKAGE = u'test-cached-schemas'
+
+
+def _context():
+    return {'model': model, 'session': model.Session, 'user': ''}
+
+
+class TestCachedSchemas(object):
+
+    @classmethod
+    def setup_class(cls):
+        standin.isolate()
+        vocab = model.Vocabulary(GENRE_VOCAB)
+        model.Session.add(vocab)
+        model.Session.flush()
+        tag = model.Tag(name=u'jazz', vocabulary_id=vocab.id)
+        model.Session.add(tag)
+        model.repo.new_revision()
+        pkg = model.Package(name=PACKAGE, title=u'Cached schemas',
+                            type=u'example_dataset_form')
+        model.Session.add(pkg)
+        pkg.extras[u'published_by'] = u'A publisher'
+        model.Session.add(model.PackageTag(package=pkg, tag=tag))
+        model.repo.commit_and_remove()
+        cache.invalidate_vocabularies()
+
+    @classmethod
+    def teardown_class(cls):
+        model.repo.rebuild_db()
+        standin.restore()
+
+    def _check(self, plugin, name, sample):
+        cached = getattr(plugin, name)()
+        fresh = getattr(type(plugin), name).uncached(plugin)
+        assert_equal(describe_schema(cached), describe_schema(fresh))
+        assert_equal(validate(copy.deepcopy(sample), cached, _context()),
+                     validate(copy.deepcopy(sample), fresh, _context()))
+
+    def test_dataset_form_to_db_schema(self):
+        self._check(ExampleDatasetForm(), 'form_to_db_schema', {
+            'name': u'test-cached-schemas-new', 'title': u'A dataset',
+            'tag_string': u'free, tags', 'published_by': u'A publisher',
+            'genre_tags': [u'jazz']})
+
+    def test_dataset_form_to_db_schema_errors(self):
+        self._check(ExampleDatasetForm(), 'form_to_db_schema', {
+            'name': PACKAGE, 'genre_tags': [u'not a genre']})
+
+    def test_dataset_db_to_form_schema(self):
+        pkg_dict = package_dictize(model.Package.get(PACKAGE), _context())
+        self._check(ExampleDatasetForm(), 'db_to_form_schema', pkg_dict)
+
+    def test_group_form_to_db_schema(self):
+        self._check(ExampleGroupForm(), 'form_to_db_schema',
+                    {'name': u'test-cached-schemas-group',
+                     'title': u'A group'})
+
+    def test_group_db_to_form_schema(self):
+        self._check(ExampleGroupForm(), 'db_to_form_schema',
+                    {'name': u'a-group'})
+
+    def test_cached_schema_is_shared(self):
+        plugin = ExampleDatasetForm()
+        assert plugin.form_to_db_schema() is plugin.form_to_db_schema()
+
+    def test_frozen(self):
+        schema = ExampleDatasetForm().db_to_form_schema()
+        assert isinstance(schema, FrozenDict)
+        assert isinstance(schema['tags'], FrozenDict)
+        validators = schema['published_by']
+        assert isinstance(validators, FrozenList)
+        assert_raises(TypeError, schema.__setitem__, 'name', [])
+        assert_raises(TypeError, schema.pop, 'name')
+        assert_raises(TypeError, schema['tags'].update, {})
+        assert_raises(TypeError, validators.append, unicode)
+        assert_raises(TypeError, validators.__setitem__, 0, unicode)
+        assert_raises(TypeError, validators.__iadd__, [unicode])
+
+    def test_copy_is_mutable(self):
+        schema = ExampleDatasetForm().db_to_form_schema().copy()
+        schema['tags']['extra'] = []
+        schema['published_by'].append(unicode)
+        assert 'extra' not in ExampleDatasetForm().db_to_form_schema()['tags']
@@ -0,0 +1,49 @@
+// Fetches the vocabulary tags matching what is typed in a chosen multiple
+// select box, from the URL in its data-autocomplete-url attribute, as
+// the page only lists the tags already selected.
+(function ($) {
+  var DELAY = 200;
+  var LIMIT = 50;
+
+  $.fn.vocabAutocomplete = function () {
+    return this.each(function () {
+      var select = $(this);
+      var url = select.attr('data-autocomplete-url');
+      var input = $('#' + this.id + '_chzn').find('input');
+      var timer = null;
+      var last = null;
+
+      input.bind('keyup', function () {
+        var q = $.trim(input.val());
+        if (q === last) {
+          return;
+        }
+        last = q;
+        clearTimeout(timer);
+        if (!q) {
+          return;
+        }
+        timer = setTimeout(function () {
+          $.getJSON(url, {q: q, limit: LIMIT}, function (result) {
+            if ($.trim(input.val()) !== q) {
+              return;
+            }
+            var present = {};
+            select.find('option').each(function () {
+              present[this.value] = true;
+            });
+            $.each(result.tags, function (i, tag) {
+              if (!present[tag]) {
+                select.append($('<option/>').val(tag).text(tag));
+              }
+            });
+            // Rebuilding the list clears the search field, so type the
+            // query again to filter the new options.
+            select.trigger('liszt:updated');
+            input.val(q).trigger('keyup');
+          });
+        }, DELAY);
+      });
+    });
+  };
+})(jQuery);
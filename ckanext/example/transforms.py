@@ -0,0 +1,316 @@
+"""
+Route-dispatched Genshi stream transformations.
+
+Every ``IGenshiStreamFilter`` is called for every rendered page, although
+most of our transformations only make sense on one or two pages.  Each
+plugin keeps its transformations in a ``StreamRules`` registry, declaring
+the ``(controller, action)`` routes they apply to, and its ``filter()``
+only runs the ones registered for the current route.  Pages with no
+matching rule get their stream back untouched.
+
+Rules select elements (or text) with an XPath expression, like a
+``genshi.filters.Transformer``, but rather than chaining one Transformer
+per rule, with each of them walking the whole event stream, all the rules
+matching a page are applied by ``apply_rules()`` in a single pass.  When
+both plugins filter the same page, the rules of the second one are merged
+into the pass set up by the first (see ``RuleStream``).
+
+Rules which only depend on the static content of one of our templates are
+declared with that ``template``.  ``StreamRules.precompile()`` applies
+them once, at startup, to a copy of the template source, so they cost
+nothing when pages are rendered.
+"""
+import os
+import re
+import stat
+import errno
+import codecs
+import logging
+
+from genshi.core import Markup, Stream, START, END, TEXT
+from genshi.input import XML, ParseError
+from genshi.path import Path
+from pylons import request
+
+log = logging.getLogger(__name__)
+
+# Matches any action of a controller, e.g. ``('package', ANY)``.
+ANY = '*'
+
+# Rule actions
+APPEND = 'append'
+SUBSTITUTE = 'substitute'
+
+
+class Rule(object):
+    """A transformation of the elements or text selected by ``path``.
+
+    ``APPEND`` rules insert ``content`` as the last children of each
+    selected element.  ``content`` is either a stream (or list of events),
+    or a callable called once per page which returns one, or ``None`` to
+    skip the rule on that page.
+
+    ``SUBSTITUTE`` rules replace the ``pattern`` regular expression with
+    ``replace`` in the selected text, at most ``count`` times in each text
+    event (0 for every match), as ``Transformer.substitute`` does.
+    """
+
+    def __init__(self, path, action, content=None, pattern=None,
+                 replace=None, count=1):
+        self.path = Path(path)
+        self.action = action
+        self.content = content
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern)
+        self.pattern = pattern
+        self.replace = replace
+        self.count = count
+
+    def resolve(self):
+        """
+        Returns the ``(rule, content)`` pair to apply on the current page,
+        or None if there is nothing to do.
+        """
+        content = self.content
+        if callable(content):
+            content = content()
+            if content is None:
+                return None
+        return self, content
+
+
+def apply_rules(stream, resolved):
+    """
+    Apply a list of resolved ``(rule, content)`` pairs to ``stream`` in a
+    single walk, testing every rule's path against each event.
+
+    As with ``Transformer``, an element selected by a rule is not tested
+    again by that rule for nested matches.
+    """
+    namespaces, variables = {}, {}
+    rules = [(rule.path.test(), rule, content)
+             for rule, content in resolved]
+    # For each rule, the depth of the selected element we are inside, if any
+    inside = [None] * len(rules)
+    # Content to append before the END event closing the given depth
+    appends = {}
+    depth = 0
+
+    for event in stream:
+        kind = event[0]
+        if kind is START:
+            depth += 1
+
+        for i, (test, rule, content) in enumerate(rules):
+            if inside[i] is not None:
+                test(event, namespaces, variables, updateonly=True)
+                selected = True
+            else:
+                selected = test(event, namespaces, variables) is True
+                if selected and kind is START:
+                    inside[i] = depth
+                    if rule.action is APPEND:
+                        appends.setdefault(depth, []).append(content)
+            if selected and kind is TEXT and rule.action is SUBSTITUTE:
+                text = rule.pattern.sub(rule.replace, event[1], rule.count)
+                if isinstance(event[1], Markup):
+                    text = Markup(text)
+                event = (TEXT, text, event[2])
+
+        if kind is END:
+            for content in appends.pop(depth, ()):
+                for subevent in content:
+                    yield subevent
+            for i in range(len(inside)):
+                if inside[i] == depth:
+                    inside[i] = None
+            depth -= 1
+
+        yield event
+
+
+class RuleStream(Stream):
+    """A stream to which ``apply_rules()`` is applied when it is iterated.
+
+    The rules to apply can still be extended until then, which is how the
+    stream filters of several plugins end up sharing a single pass.  The
+    pass runs as the page is serialized, after the filters have returned,
+    so each filter's ``timers`` (see ``metrics.timer``) are entered when
+    iteration starts and exited once the stream is exhausted.
+    """
+    __slots__ = ['rules', 'timers']
+
+    def __init__(self, stream, rules, timers=()):
+        self.rules = list(rules)
+        self.timers = list(timers)
+        Stream.__init__(self, self._generate(stream),
+                        serializer=getattr(stream, 'serializer', None))
+
+    def __iter__(self):
+        if not self.timers:
+            return iter(self.events)
+        return self._timed()
+
+    def _timed(self):
+        timers = list(self.timers)
+        for timer in timers:
+            timer.__enter__()
+        try:
+            for event in self.events:
+                yield event
+        finally:
+            for timer in reversed(timers):
+                timer.__exit__(None, None, None)
+
+    def _generate(self, stream):
+        for event in apply_rules(stream, self.rules):
+            yield event
+
+
+def _private_directory(path):
+    """
+    Creates the directory ``path``, readable by its owner only, unless it
+    exists.  Raises OSError if it is not a directory of the current user
+    which only that user can write to.
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError(errno.EPERM, 'Not a directory private to this user',
+                      path)
+
+
+class StreamRules(object):
+    """A registry of stream transformation rules indexed by route.
+    """
+
+    def __init__(self):
+        self._rules = {}
+        # template name -> [(routes, rule)] of the rules to precompile
+        self._static = {}
+
+    def add(self, routes, rule, template=None):
+        """
+        Register ``rule`` to be applied on each of the given
+        ``(controller, action)`` routes.  ``action`` may be ``ANY``.
+
+        If the rule only depends on the static content of the ``template``
+        (a path relative to a template directory), it is applied to the
+        template source by ``precompile()`` instead, and only on the
+        routes if precompiling it fails.
+        """
+        for route in routes:
+            self._rules.setdefault(tuple(route), []).append(rule)
+        if template is not None:
+            self._static.setdefault(template, []).append((routes, rule))
+
+    def append(self, routes, path, content, template=None):
+        """
+        Register a rule appending ``content`` to the elements selected by
+        ``path`` on the given routes.
+        """
+        self.add(routes, Rule(path, APPEND, content=content), template)
+
+    def substitute(self, routes, path, pattern, replace, template=None,
+                   count=1):
+        """
+        Register a rule replacing ``pattern`` with ``replace``, at most
+        ``count`` times, in the text selected by ``path`` on the given
+        routes.
+        """
+        self.add(routes, Rule(path, SUBSTITUTE, pattern=pattern,
+                              replace=replace, count=count), template)
+
+    def _remove(self, routes, rule):
+        for route in routes:
+            rules = self._rules.get(tuple(route), [])
+            if rule in rules:
+                rules.remove(rule)
+
+    def precompile(self, template_dirs, output_dir):
+        """
+        Writes a copy of each template with static rules to
+        ``output_dir``, with the rules applied, and stops applying them to
+        the pages.  The template source is the first one found in
+        ``template_dirs``.  ``output_dir`` must be searched for templates
+        before those directories.
+
+        Returns False, precompiling nothing, if ``output_dir`` can't be
+        created or belongs to another user or other users can write to
+        it, in which case it must not be searched for templates.
+        """
+        try:
+            _private_directory(output_dir)
+        except OSError, e:
+            log.error('Not precompiling templates into %s, the rules will '
+                      'be applied to every page: %s' % (output_dir, e))
+            return False
+        for template, static in self._static.items():
+            sources = [os.path.join(d, template) for d in template_dirs]
+            sources = [f for f in sources if os.path.exists(f)]
+            if not sources:
+                log.warn('Template %s not found, its rules will be applied '
+                         'to every page' % template)
+                continue
+            path = os.path.join(output_dir, template)
+            try:
+                with codecs.open(sources[0], encoding='utf-8') as f:
+                    source = f.read()
+                resolved = [rule.resolve() for routes, rule in static]
+                events = apply_rules(XML(source),
+                                     [pair for pair in resolved if pair])
+                compiled = Stream(list(events)).render('xml',
+                                                       encoding='utf-8')
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path), 0700)
+                # Several processes may be writing the same file
+                tmp = '%s.%d' % (path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    f.write(compiled)
+                os.rename(tmp, path)
+            except (ParseError, IOError, OSError), e:
+                log.warn('Could not precompile %s, its rules will be '
+                         'applied to every page: %s' % (template, e))
+                continue
+            for routes, rule in static:
+                self._remove(routes, rule)
+            log.debug('Precompiled %d rules into %s' % (len(static), path))
+            del self._static[template]
+        return True
+
+    def match(self, controller, action):
+        """
+        Returns the rules registered for a route, in the order they were
+        added.
+        """
+        return self._rules.get((controller, action), []) + \
+            self._rules.get((controller, ANY), [])
+
+    def apply(self, stream, timer=None):
+        """
+        Apply the rules matching the current request's route, timing the
+        pass with ``timer`` if given.
+        """
+        routes = request.environ.get('pylons.routes_dict') or {}
+        resolved = []
+        for rule in self.match(routes.get('controller'),
+                               routes.get('action')):
+            pair = rule.resolve()
+            if pair is not None:
+                resolved.append(pair)
+        if not resolved:
+            return stream
+        if isinstance(stream, RuleStream):
+            # Another of our filters has already set up a pass over this
+            # stream, which hasn't started yet: join it.
+            stream.rules.extend(resolved)
+            if timer is not None:
+                stream.timers.append(timer)
+            return stream
+        return RuleStream(stream, resolved,
+                          [timer] if timer is not None else [])
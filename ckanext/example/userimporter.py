@@ -0,0 +1,279 @@
+"""
+Parallel bulk import of users, used by ``paster example import-users``.
+
+Users are read from a CSV file (with a header row naming the fields) or a
+JSON lines file, ``batch_size`` at a time.  Each record is validated
+against the schema ``CustomUserController`` registers new users with,
+which requires a full name, and its password is hashed, by a pool of
+worker processes: hashing is the CPU bound part of creating a user.  The
+parent process writes the users of each batch in a single transaction,
+while the workers process the next one.
+
+Records which fail to parse, validate or save are written to a reject
+file, one JSON object per line with the line number, the record (without
+its passwords) and the errors.  In a dry run the records are validated
+and rejected the same way, but no password is hashed and nothing is
+written to the database.
+"""
+import csv
+import json
+import time
+import logging
+import multiprocessing
+
+from ckan import model
+from ckan.logic import get_action
+from ckan.lib.navl.dictization_functions import validate
+from ckan.lib.dictization import model_save
+
+from controller import CustomUserController
+
+log = logging.getLogger(__name__)
+
+PASSWORD_FIELDS = ('password', 'password1', 'password2')
+
+# Largest number of names looked up in the database with one query
+QUERY_SIZE = 500
+
+# The context and schema used by ``validate_record``, set in each worker
+_context = None
+_schema = None
+_hash_passwords = True
+
+
+def _init_validation(user, hash_passwords=True):
+    global _context, _schema, _hash_passwords
+    _context = {'model': model, 'session': model.Session, 'user': user}
+    _schema = CustomUserController()._new_form_to_db_schema()
+    _hash_passwords = hash_passwords
+
+
+def read_records(fileobj, format='csv'):
+    """
+    Yields ``(line number, record)`` pairs from a CSV file, whose header
+    row names the fields, or a JSON lines file of objects.  A record which
+    can't be parsed is yielded as the error message instead.
+    """
+    if format == 'jsonl':
+        for number, line in enumerate(fileobj, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError, e:
+                yield number, str(e)
+                continue
+            if not isinstance(record, dict):
+                record = 'Not a JSON object'
+            yield number, record
+    elif format == 'csv':
+        reader = csv.DictReader(fileobj)
+        for row in reader:
+            if None in row:
+                yield reader.line_num, 'More values than fields'
+                continue
+            yield reader.line_num, dict(
+                (key, value.decode('utf-8'))
+                for key, value in row.iteritems() if value is not None)
+    else:
+        raise ValueError('Unknown input format "%s"' % format)
+
+
+def hash_password(password):
+    """
+    Returns the hash ``model.User`` stores for ``password``.
+    """
+    user = model.User()
+    user._set_password(password)
+    return user._password
+
+
+def validate_record(numbered_record):
+    """
+    Validates a ``(line number, record)`` pair and hashes its password,
+    returning the line number, the record, the validated data and the
+    errors.  The data holds the hash of the password in ``password_hash``,
+    and none of the password fields.
+    """
+    number, record = numbered_record
+    record = dict(record)
+    # Accept a single password, where the registration form has the user
+    # type it twice.
+    if 'password' in record:
+        password = record.pop('password')
+        record.setdefault('password1', password)
+        record.setdefault('password2', password)
+    try:
+        data, errors = validate(record, _schema, _context)
+    finally:
+        model.Session.remove()
+    if errors:
+        return number, record, None, errors
+    password = data.get('password')
+    for key in PASSWORD_FIELDS:
+        data.pop(key, None)
+    if _hash_passwords:
+        data['password_hash'] = hash_password(password)
+    return number, record, data, errors
+
+
+class UserImporter(object):
+    """Imports the users of a CSV or JSON lines file, validating them in
+    ``workers`` processes and writing them ``batch_size`` at a time.
+    """
+
+    def __init__(self, user, rejects, workers=None, batch_size=1000,
+                 dry_run=False):
+        self.user = user
+        self.rejects = rejects
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.rows = 0
+        self.imported = 0
+        self.rejected = 0
+        self._started = None
+
+    def _batches(self, records):
+        batch = []
+        for number, record in records:
+            if not isinstance(record, dict):
+                self.rows += 1
+                self._reject(number, None, {'record': [record]})
+                continue
+            batch.append((number, record))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _reject(self, number, record, errors):
+        if record is not None:
+            record = dict((key, value) for key, value in record.iteritems()
+                          if key not in PASSWORD_FIELDS)
+        self.rejects.write(json.dumps({'line': number, 'record': record,
+                                       'errors': errors}) + '\n')
+        self.rejected += 1
+
+    def _save(self, data):
+        """
+        Creates a user as ``user_create`` does, with the password hashed
+        by the worker.
+        """
+        password_hash = data.pop('password_hash')
+        context = {'model': model, 'session': model.Session,
+                   'user': self.user}
+        user = model_save.user_dict_save(data, context)
+        user._password = password_hash
+        model.Session.flush()
+        get_action('activity_create')(
+            dict(context, defer_commit=True),
+            {'user_id': user.id, 'object_id': user.id,
+             'activity_type': 'new user'},
+            ignore_auth=True)
+
+    def _in_use(self, names):
+        """
+        Returns those of ``names`` which a user already has.
+        """
+        names = list(names)
+        in_use = set()
+        for start in range(0, len(names), QUERY_SIZE):
+            query = model.Session.query(model.User.name).filter(
+                model.User.name.in_(names[start:start + QUERY_SIZE]))
+            in_use.update(name for (name,) in query)
+        return in_use
+
+    def _write(self, results):
+        """
+        Writes the valid users of a batch in one transaction, falling back
+        to one transaction per user if it fails.  In a dry run, nothing is
+        written, so only the duplicates within a batch are rejected.
+        """
+        valid = []
+        names = set()
+        for number, record, data, errors in results:
+            self.rows += 1
+            if errors:
+                self._reject(number, record, errors)
+            elif data['name'] in names:
+                self._reject(number, record,
+                             {'name': ['Duplicate of an earlier record']})
+            else:
+                names.add(data['name'])
+                valid.append((number, record, data))
+        # A batch is validated while the previous one is being written, so
+        # its names are checked again against the users written since.
+        in_use = self._in_use(names)
+        for number, record, data in valid:
+            if data['name'] in in_use:
+                self._reject(number, record,
+                             {'name': ['That login name is not available.']})
+        valid = [user for user in valid if user[2]['name'] not in in_use]
+
+        if self.dry_run:
+            self.imported += len(valid)
+        else:
+            try:
+                for number, record, data in valid:
+                    self._save(dict(data))
+                model.repo.commit()
+                self.imported += len(valid)
+            except Exception, e:
+                model.Session.rollback()
+                log.warn('Writing the batch failed (%s), writing its users '
+                         'one at a time' % e)
+                for number, record, data in valid:
+                    try:
+                        self._save(dict(data))
+                        model.repo.commit()
+                        self.imported += 1
+                    except Exception, e:
+                        model.Session.rollback()
+                        self._reject(number, record, {'database': [str(e)]})
+        model.Session.remove()
+
+        elapsed = time.time() - self._started
+        log.info("%d records read, %d %s, %d rejected (%.0f records/s)" % (
+            self.rows, self.imported,
+            'valid' if self.dry_run else 'imported', self.rejected,
+            self.rows / max(elapsed, 0.001)))
+
+    def run(self, records):
+        """
+        Imports the users of an iterable of ``(line number, record)``
+        pairs, as returned by ``read_records``.
+        """
+        self._started = time.time()
+        # Don't let the workers inherit the parent's database connections
+        _init_validation(self.user, not self.dry_run)
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        if self.workers <= 1:
+            for batch in self._batches(records):
+                self._write(map(validate_record, batch))
+            return
+
+        pool = multiprocessing.Pool(self.workers, _init_validation,
+                                    (self.user, not self.dry_run))
+        try:
+            chunksize = max(1, self.batch_size / (self.workers * 4))
+            pending = None
+            # Validate the next batch while writing the current one
+            for batch in self._batches(records):
+                validating = pool.map_async(validate_record, batch,
+                                            chunksize)
+                if pending is not None:
+                    self._write(pending.get())
+                pending = validating
+            if pending is not None:
+                self._write(pending.get())
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()